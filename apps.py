@@ -5,3 +5,6 @@ class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
     label = "authentication"
+
+    def ready(self):
+        from authentication import signals  # noqa: F401
@@ -1,11 +1,21 @@
+import asyncio
+from functools import partial
 from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.utils.functional import empty
 from django.utils.translation import gettext_lazy as _
 from rest_framework import exceptions
 from rest_framework.authentication import TokenAuthentication
 
+from authentication.caches import CachedTokenUser, TokenEntry, get_token_cache
+from authentication.expiry import last_used_recorder, token_is_expired
 from authentication.models import MultiToken
 
+_unresolved = object()
+
 
 async def get_websocket_authorization_query(scope):
     """
@@ -20,6 +30,55 @@ async def get_websocket_authorization_query(scope):
 class MultiTokenAuthentication(TokenAuthentication):
     model = MultiToken
 
+    def authenticate(self, request):
+        """
+        Authenticates the request once, the outcome is kept on the django request so the
+        middleware and DRF share a single token lookup.
+        """
+        http_request = getattr(request, '_request', request)
+        result = getattr(http_request, '_multi_token_auth', _unresolved)
+        if result is _unresolved:
+            try:
+                result = super().authenticate(request)
+            except exceptions.AuthenticationFailed as exc:
+                result = exc
+            http_request._multi_token_auth = result
+        if isinstance(result, exceptions.AuthenticationFailed):
+            raise result
+        return result
+
+    def authenticate_credentials(self, key):
+        token_cache = get_token_cache()
+        entry = token_cache.get(key) if token_cache is not None else None
+        # an expired looking entry may predate the last write back, the database has the final word.
+        if entry is not None and entry.created is not None \
+                and not token_is_expired(entry.key, entry.created, entry.last_used):
+            self.record_use(key)
+            return CachedTokenUser(entry), entry.as_token()
+
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user').get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        if token_is_expired(token.key, token.created, token.last_used):
+            token.delete()
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+
+        self.record_use(key)
+        if token_cache is not None:
+            token_cache.set(TokenEntry.from_token(token))
+        return token.user, token
+
+    def record_use(self, key):
+        if last_used_recorder.enabled:
+            last_used_recorder.touch(key)
+            last_used_recorder.maybe_flush()
+
 
 class WebsocketMultiTokenAuthentication:
     keyword = 'Token'
@@ -31,7 +90,10 @@ class WebsocketMultiTokenAuthentication:
         from rest_framework.authtoken.models import Token
         return Token
 
-    async def authenticate_websocket(self, scope):
+    async def get_token_key(self, scope):
+        """
+        Returns the token key sent by the websocket client, None when no token authorization was sent.
+        """
         auth = (await get_websocket_authorization_query(scope)).split()
         if not auth or auth[0].lower() != self.keyword.lower().encode():
             return None
@@ -43,14 +105,26 @@ class WebsocketMultiTokenAuthentication:
             msg = _('Invalid token header. Token string should not contain spaces.')
             raise exceptions.AuthenticationFailed(msg)
         try:
-            token = auth[1].decode()
+            return auth[1].decode()
         except UnicodeError:
             msg = _('Invalid token header. Token string should not contain invalid characters.')
             raise exceptions.AuthenticationFailed(msg)
 
-        return await self.authenticate_credentials(token)
+    async def authenticate_websocket(self, scope):
+        key = await self.get_token_key(scope)
+        if key is None:
+            return None
+        return await self.authenticate_credentials(key)
 
     async def authenticate_credentials(self, key):
+        token_cache = get_token_cache()
+        entry = await token_cache.aget(key) if token_cache is not None else None
+        # an expired looking entry may predate the last write back, the database has the final word.
+        if entry is not None and entry.created is not None \
+                and not token_is_expired(entry.key, entry.created, entry.last_used):
+            await self.arecord_use(key)
+            return CachedTokenUser(entry), entry.as_token()
+
         model = await self.get_model()
         try:
             token = await model.objects.select_related('user').aget(key=key)
@@ -60,4 +134,76 @@ class WebsocketMultiTokenAuthentication:
         if not token.user.is_active:
             raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
 
+        if token_is_expired(token.key, token.created, token.last_used):
+            await token.adelete()
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+
+        await self.arecord_use(key)
+        if token_cache is not None:
+            await token_cache.aset(TokenEntry.from_token(token))
         return token.user, token
+
+    async def arecord_use(self, key):
+        if not last_used_recorder.enabled:
+            return
+        last_used_recorder.touch(key)
+        if last_used_recorder.flush_due():
+            await sync_to_async(last_used_recorder.flush)()
+
+
+class WebsocketTokenResolver:
+    """
+    Resolves websocket tokens for every connection of the process.
+
+    Concurrent lookups of the same key wait on a single in-flight query, resolved tokens are kept in the
+    token cache, so a reconnect storm costs one query per distinct token. Users of cached tokens are only
+    loaded by `aload_user`, concurrent loads of the same user share one query.
+    """
+
+    authentication_class = WebsocketMultiTokenAuthentication
+
+    def __init__(self):
+        self.authentication = self.authentication_class()
+        self._in_flight = {}
+
+    async def _coalesce(self, key, lookup):
+        loop = asyncio.get_running_loop()
+        task = self._in_flight.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(lookup())
+            self._in_flight[key] = task
+            task.add_done_callback(partial(self._forget, key))
+        # a dropped connection must not cancel the lookup other connections are waiting on.
+        return await asyncio.shield(task)
+
+    async def resolve(self, key):
+        return await self._coalesce(('token', key), partial(self.authentication.authenticate_credentials, key))
+
+    async def resolve_user(self, key):
+        """
+        The token's user, a CachedTokenUser answering pk / is_active / is_authenticated without a query
+        when the token was cached, AnonymousUser for a bad token.
+        """
+        try:
+            user, token = await self.resolve(key)
+        except exceptions.AuthenticationFailed:
+            return AnonymousUser()
+        return user
+
+    async def aload_user(self, user):
+        """
+        `user` fully loaded, from the event loop. The row is read once and kept on the CachedTokenUser.
+        """
+        if not isinstance(user, CachedTokenUser):
+            return user
+        if user._wrapped is empty:
+            manager = get_user_model()._default_manager
+            user._wrapped = await self._coalesce(('user', user.pk), partial(manager.aget, pk=user.pk))
+        return user._wrapped
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+
+websocket_token_resolver = WebsocketTokenResolver()
@@ -3,82 +3,105 @@ adapted from django's ModelBackend, just adding the possibility of authenticatin
  in addition to the USERNAME field.
 """
 
-from urllib.parse import parse_qs
-
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-from django.utils.translation import gettext_lazy as _
-from rest_framework import exceptions
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.functions import Upper
 
-from authentication.models import MultiToken
+# re-exported, the websocket authentication with the expiry checks lives in authentication.authentication.
+from authentication.authentication import WebsocketMultiTokenAuthentication  # noqa: F401
+from authentication.caches import get_all_permissions, get_user_permissions
+from authentication.hashers import run_dummy_hasher, arun_dummy_hasher, verify_password, averify_password
+from authentication.validators import phone_variants
 
 UserModel = get_user_model()
 
 
-class PhoneBackend(ModelBackend):
+def _has_field(name: str) -> bool:
+    try:
+        UserModel._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+class CachedPermissionsMixin:
+    """
+    Serves ModelBackend's permission checks from the cached permission sets, shared by every worker,
+    instead of two queries per user and request.
+    """
+
+    def _get_cached_permissions(self, user_obj, obj, attr):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        perm_cache_name = f'_{attr}_perm_cache'
+        if not hasattr(user_obj, perm_cache_name):
+            if user_obj.is_superuser:
+                perms = get_all_permissions()
+            else:
+                perms = getattr(get_user_permissions(user_obj), f'{attr}_permissions')
+            setattr(user_obj, perm_cache_name, set(perms))
+        return getattr(user_obj, perm_cache_name)
+
+    def get_user_permissions(self, user_obj, obj=None):
+        return self._get_cached_permissions(user_obj, obj, 'user')
+
+    def get_group_permissions(self, user_obj, obj=None):
+        return self._get_cached_permissions(user_obj, obj, 'group')
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            if user_obj.is_superuser:
+                user_obj._perm_cache = set(get_all_permissions())
+            else:
+                permissions = get_user_permissions(user_obj)
+                user_obj._perm_cache = {*permissions.user_permissions, *permissions.group_permissions}
+        return user_obj._perm_cache
+
+
+class PhoneBackend(CachedPermissionsMixin, ModelBackend):
+    """
+    Authenticates with a phone number, an email or the username, each resolved with a single indexed lookup.
+
+    Phone numbers match any spelling accepted by PhoneValidator (+213, 00213 or 0 prefix), emails are
+    case insensitive through the `UPPER(email)` index created by the app's migrations.
+    """
+
+    def get_login_queryset(self, username: str):
+        variants = phone_variants(username)
+        if variants and _has_field('phone'):
+            return UserModel.objects.filter(phone__in=variants)
+        if '@' in username and _has_field('email'):
+            return UserModel.objects.alias(email_upper=Upper('email')).filter(email_upper=username.upper())
+        return UserModel.objects.filter(**{UserModel.USERNAME_FIELD: username})
+
     def authenticate(self, request, username: str = None, password: str = None, **kwargs):
         if username is None:
             username = kwargs.get(UserModel.USERNAME_FIELD)
         if username is None or password is None:
             return
         try:
-            user = UserModel.objects.get(phone__iexact=username)
-        except UserModel.DoesNotExist:
+            user = self.get_login_queryset(username).get()
+        except (UserModel.DoesNotExist, UserModel.MultipleObjectsReturned):
             # Run the default password hasher once to reduce the timing
             # difference between an existing and a nonexistent user (#20760).
-            UserModel().set_password(password)
+            run_dummy_hasher(password)
         else:
-            if user.check_password(password) and self.user_can_authenticate(user):
+            if verify_password(user, password) and self.user_can_authenticate(user):
                 return user
 
-
-async def get_websocket_authorization_query(scope):
-    """
-    Return request's 'Authorization:' header, as a bytestring.
-
-    Hide some test client ickyness where the header can be unicode.
-    """
-    auth = parse_qs(scope['query_string']).get(b'Authorization', [b''])[0]
-    return auth
-
-
-class WebsocketMultiTokenAuthentication:
-    keyword = 'Token'
-    model = MultiToken
-
-    async def get_model(self):
-        if self.model is not None:
-            return self.model
-        from rest_framework.authtoken.models import Token
-        return Token
-
-    async def authenticate_websocket(self, scope):
-        auth = (await get_websocket_authorization_query(scope)).split()
-        if not auth or auth[0].lower() != self.keyword.lower().encode():
-            return None
-
-        if len(auth) == 1:
-            msg = _('Invalid token header. No credentials provided.')
-            raise exceptions.AuthenticationFailed(msg)
-        elif len(auth) > 2:
-            msg = _('Invalid token header. Token string should not contain spaces.')
-            raise exceptions.AuthenticationFailed(msg)
-        try:
-            token = auth[1].decode()
-        except UnicodeError:
-            msg = _('Invalid token header. Token string should not contain invalid characters.')
-            raise exceptions.AuthenticationFailed(msg)
-
-        return await self.authenticate_credentials(token)
-
-    async def authenticate_credentials(self, key):
-        model = await self.get_model()
+    async def aauthenticate(self, request, username: str = None, password: str = None, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
         try:
-            token = await model.objects.select_related('user').aget(key=key)
-        except model.DoesNotExist:
-            raise exceptions.AuthenticationFailed(_('Invalid token.'))
-
-        if not token.user.is_active:
-            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            user = await self.get_login_queryset(username).aget()
+        except (UserModel.DoesNotExist, UserModel.MultipleObjectsReturned):
+            await arun_dummy_hasher(password)
+        else:
+            if await averify_password(user, password) and self.user_can_authenticate(user):
+                return user
 
-        return token.user, token
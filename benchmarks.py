@@ -0,0 +1,150 @@
+"""
+Micro benchmarks of the app's hot paths, run with `manage.py auth_benchmark <name>`.
+"""
+import math
+import random
+import string
+import timeit
+from types import SimpleNamespace
+
+from asgiref.local import Local
+
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import render_to_string
+from django.utils.translation import gettext as _
+
+from authentication.contexts import CurrentApplicationContext
+from authentication.mail import PasswordResetEmailRenderer
+from authentication.utils import generate_otp, generate_otps, OTP_ALPHABET, OTP_LENGTH
+
+
+def _best(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def _fake_verifications(count: int) -> list:
+    verifications = []
+    for i in range(count):
+        otp = generate_otp()
+        verifications.append(SimpleNamespace(
+            email=f"user{i}@example.com", raw_otp=otp, reset_link=f"https://app.theschool.pro/password/reset/?otp={otp}"
+        ))
+    return verifications
+
+
+def _render_per_message(verification) -> EmailMultiAlternatives:
+    invitation_html = render_to_string("mail/password_reset.html",
+                                       {"link": verification.reset_link, "otp": verification.raw_otp})
+    text_content = f'You requested a password reset, please follow the link {verification.reset_link}'
+    msg = EmailMultiAlternatives(_('Password reset'), text_content, "contact@theschool.pro",
+                                 [verification.email])
+    msg.attach_alternative(invitation_html, "text/html")
+    return msg
+
+
+def bench_reset_emails(count: int = 1000, repeat: int = 5) -> dict:
+    """
+    Per message `render_to_string` against the batch renderer.
+    """
+    verifications = _fake_verifications(count)
+    renderer = PasswordResetEmailRenderer()
+    per_message = _best(lambda: [_render_per_message(v) for v in verifications], repeat)
+    batch = _best(lambda: renderer.build_messages(verifications), repeat)
+    return {
+        'messages': count,
+        'per_message_seconds': per_message,
+        'batch_seconds': batch,
+        'speedup': per_message / batch if batch else None,
+    }
+
+
+def _legacy_generate_otp():
+    chars = string.ascii_lowercase + string.ascii_uppercase + '123456789'
+    otp = ""
+    for i in range(7):
+        otp += random.choice(chars)
+    return otp
+
+
+def bench_otp_generation(count: int = 10000, repeat: int = 5) -> dict:
+    """
+    The former `random.choice` loop against the batch `secrets` generator.
+    """
+    legacy = _best(lambda: [_legacy_generate_otp() for _ in range(count)], repeat)
+    single = _best(lambda: [generate_otp() for _ in range(count)], repeat)
+    batch = _best(lambda: generate_otps(count), repeat)
+    return {
+        'otps': count,
+        'legacy_seconds': legacy,
+        'single_seconds': single,
+        'batch_seconds': batch,
+        'speedup': legacy / batch if batch else None,
+    }
+
+
+def otp_entropy_report(count: int = 100000, length: int = OTP_LENGTH, alphabet: str = OTP_ALPHABET,
+                       guesses: int = 30) -> dict:
+    """
+    Entropy of an OTP, collision odds with `count` OTPs active at once and the odds that `guesses` random
+    guesses (the hourly `otp_ip` rate by default) hit one of them.
+    """
+    space = len(alphabet) ** length
+    return {
+        'length': length,
+        'alphabet_size': len(alphabet),
+        'entropy_bits': length * math.log2(len(alphabet)),
+        'space': space,
+        'active_otps': count,
+        # birthday bound: probability that two of the active OTPs collide.
+        'collision_probability': -math.expm1(-count * (count - 1) / (2 * space)),
+        'new_otp_collision_probability': count / space,
+        'guesses': guesses,
+        'guess_success_probability': -math.expm1(guesses * math.log1p(-count / space)),
+    }
+
+
+def _legacy_context_cycle(local, request):
+    local.request = request
+    local.referrer = request.META.get("HTTP_REFERER")
+    if request.user.is_authenticated:
+        local.user = request.user
+    local.user
+    if hasattr(local, "request"):
+        del local.request
+    if hasattr(local, "referrer"):
+        del local.referrer
+    if hasattr(local, "user"):
+        del local.user
+
+
+def _context_cycle(request):
+    token = CurrentApplicationContext.activate(request=request, referrer=request.META.get("HTTP_REFERER"))
+    CurrentApplicationContext.context.user
+    CurrentApplicationContext.reset(token)
+
+
+def bench_request_context(count: int = 100000, repeat: int = 5) -> dict:
+    """
+    Setting, reading and clearing the request context: the former asgiref `Local` against the context variable.
+    """
+    request = SimpleNamespace(META={'HTTP_REFERER': 'https://app.theschool.pro/'},
+                              user=SimpleNamespace(is_authenticated=True))
+    local = Local()
+    legacy = _best(lambda: [_legacy_context_cycle(local, request) for _ in range(count)], repeat)
+    current = _best(lambda: [_context_cycle(request) for _ in range(count)], repeat)
+    return {
+        'requests': count,
+        'local_seconds': legacy,
+        'contextvar_seconds': current,
+        'local_per_request_us': legacy / count * 1e6,
+        'contextvar_per_request_us': current / count * 1e6,
+        'speedup': legacy / current if current else None,
+    }
+
+
+BENCHMARKS = {
+    'reset-emails': bench_reset_emails,
+    'otp-generation': bench_otp_generation,
+    'otp-entropy': otp_entropy_report,
+    'request-context': bench_request_context,
+}
@@ -0,0 +1,359 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import partial
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache, caches
+from django.db.models import Exists, OuterRef, Q
+from django.utils.functional import SimpleLazyObject
+
+PERMISSIONS_GENERATION_KEY = 'permissions-generation'
+PERMISSIONS_CHANGED_AT_KEY = 'permissions-changed-at'
+USER_GROUPS_CACHE_KEY = 'user-groups:{}:{}'
+USER_PERMISSIONS_CACHE_KEY = 'user-permissions:{}:{}'
+ALL_PERMISSIONS_CACHE_KEY = 'all-permissions:{}'
+CATALOG_CACHE_KEY = 'catalog:{}:{}:{}'
+
+DEFAULT_TOKEN_CACHE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'KEY_PREFIX': 'multitoken',
+    'MAX_SIZE': 10000,
+    'LOCAL_TTL': 5,
+    'SHARED_TTL': 300,
+}
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache, entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenEntry(NamedTuple):
+    """
+    What the authentication layer needs to know about a resolved MultiToken.
+    """
+    key: str
+    user_id: int
+    is_active: bool
+    created: Optional[datetime] = None
+    last_used: Optional[datetime] = None
+
+    @classmethod
+    def from_token(cls, token) -> 'TokenEntry':
+        return cls(key=token.key, user_id=token.user_id, is_active=token.user.is_active, created=token.created,
+                   last_used=token.last_used)
+
+    def as_token(self):
+        from authentication.models import MultiToken
+
+        token = MultiToken(key=self.key, user_id=self.user_id, created=self.created, last_used=self.last_used)
+        token._state.adding = False
+        return token
+
+
+class CachedTokenUser(SimpleLazyObject):
+    """
+    Stand-in for the token's user built from a cache entry.
+
+    Answers the authentication checks (pk, is_active, is_authenticated) from the entry,
+    the user row is only loaded when any other attribute is accessed.
+    """
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, entry: TokenEntry):
+        self.__dict__['_entry'] = entry
+        manager = get_user_model()._default_manager
+        super().__init__(partial(manager.get, pk=entry.user_id))
+
+    def __bool__(self):
+        return True
+
+    @property
+    def pk(self):
+        return self._entry.user_id
+
+    @property
+    def is_active(self):
+        return self._entry.is_active
+
+
+class TokenCache:
+    """
+    Two tier cache of resolved tokens: a small in-process LRU in front of django's cache framework.
+
+    The local tier is not invalidated across processes, keep its TTL short.
+    """
+
+    def __init__(self, cache_alias='default', key_prefix='multitoken', max_size=10000, local_ttl=5,
+                 shared_ttl=300):
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+        self.shared_ttl = shared_ttl
+        self.local = LRUCache(max_size=max_size, ttl=local_ttl)
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, key: str) -> str:
+        return f'{self.key_prefix}:{key}'
+
+    def get(self, key: str) -> Optional[TokenEntry]:
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        entry = self.shared.get(self.make_key(key))
+        if entry is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        entry = TokenEntry(*entry)
+        self.local.set(key, entry)
+        return entry
+
+    async def aget(self, key: str) -> Optional[TokenEntry]:
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        entry = await self.shared.aget(self.make_key(key))
+        if entry is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        entry = TokenEntry(*entry)
+        self.local.set(key, entry)
+        return entry
+
+    def set(self, entry: TokenEntry):
+        self.local.set(entry.key, entry)
+        self.shared.set(self.make_key(entry.key), tuple(entry), self.shared_ttl)
+
+    async def aset(self, entry: TokenEntry):
+        self.local.set(entry.key, entry)
+        await self.shared.aset(self.make_key(entry.key), tuple(entry), self.shared_ttl)
+
+    def delete(self, key: str):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        self.local.delete_many(keys)
+        self.shared.delete_many([self.make_key(key) for key in keys])
+
+    def clear(self):
+        """
+        Drops the local tier only, the shared cache may hold other data.
+        """
+        self.local.clear()
+
+    def stats(self) -> dict:
+        return {
+            'local_hits': self.local.hits,
+            'local_misses': self.local.misses,
+            'shared_hits': self.shared_hits,
+            'shared_misses': self.shared_misses,
+            'evictions': self.local.evictions,
+            'size': len(self.local),
+            'max_size': self.local.max_size,
+        }
+
+
+_token_cache = None
+
+
+def get_token_cache() -> Optional[TokenCache]:
+    """
+    Returns the process wide token cache configured by `settings.MULTI_TOKEN_CACHE`, None when disabled.
+    """
+    global _token_cache
+    if _token_cache is None:
+        config = {**DEFAULT_TOKEN_CACHE, **getattr(settings, 'MULTI_TOKEN_CACHE', {})}
+        if not config['ENABLED']:
+            return None
+        _token_cache = TokenCache(
+            cache_alias=config['CACHE_ALIAS'],
+            key_prefix=config['KEY_PREFIX'],
+            max_size=config['MAX_SIZE'],
+            local_ttl=config['LOCAL_TTL'],
+            shared_ttl=config['SHARED_TTL'],
+        )
+    return _token_cache
+
+
+def reset_token_cache():
+    global _token_cache
+    _token_cache = None
+
+
+def get_permissions_generation() -> int:
+    """
+    Global generation of groups and permissions, cached sets of an older generation are never read again.
+
+    Seeded from the clock, a generation key evicted from the cache never restarts at a value already used.
+    """
+    generation = cache.get(PERMISSIONS_GENERATION_KEY)
+    if generation is None:
+        seed = time.time_ns()
+        cache.add(PERMISSIONS_GENERATION_KEY, seed, None)
+        generation = cache.get(PERMISSIONS_GENERATION_KEY, seed)
+    return generation
+
+
+def bump_permissions_generation():
+    """
+    Invalidates every cached group and permission set at once, called when a group or a permission changes.
+    """
+    try:
+        cache.incr(PERMISSIONS_GENERATION_KEY)
+    except ValueError:
+        cache.add(PERMISSIONS_GENERATION_KEY, time.time_ns(), None)
+    cache.set(PERMISSIONS_CHANGED_AT_KEY, time.time(), None)
+
+
+def get_permissions_changed_at() -> Optional[datetime]:
+    """
+    When the groups and permissions last changed, None when unknown to the cache.
+    """
+    changed_at = cache.get(PERMISSIONS_CHANGED_AT_KEY)
+    if changed_at is None:
+        return None
+    return datetime.fromtimestamp(changed_at, tz=timezone.utc)
+
+
+def _permission_names(rows) -> set:
+    return {f'{app_label}.{codename}' for app_label, codename in rows}
+
+
+class UserPermissions(NamedTuple):
+    user_permissions: frozenset
+    group_permissions: frozenset
+
+    @classmethod
+    def load(cls, user_id) -> 'UserPermissions':
+        """
+        The user's own and group permissions in one query.
+        """
+        direct = Permission.objects.filter(user=user_id, pk=OuterRef('pk'))
+        via_group = Group.permissions.through.objects.filter(group__user=user_id, permission=OuterRef('pk'))
+        rows = Permission.objects.annotate(direct=Exists(direct), via_group=Exists(via_group)) \
+            .filter(Q(direct=True) | Q(via_group=True)) \
+            .values_list('content_type__app_label', 'codename', 'direct', 'via_group')
+        user_permissions, group_permissions = set(), set()
+        for app_label, codename, is_direct, is_via_group in rows:
+            name = f'{app_label}.{codename}'
+            if is_direct:
+                user_permissions.add(name)
+            if is_via_group:
+                group_permissions.add(name)
+        return cls(frozenset(user_permissions), frozenset(group_permissions))
+
+
+def get_user_permissions(user) -> UserPermissions:
+    """
+    The user's permission sets, cached in django's cache until the user's memberships or permissions,
+    or any group or permission, change.
+    """
+    key = USER_PERMISSIONS_CACHE_KEY.format(user.pk, get_permissions_generation())
+    permissions = cache.get(key)
+    if permissions is None:
+        permissions = UserPermissions.load(user.pk)
+        cache.set(key, tuple(permissions), getattr(settings, 'USER_PERMISSIONS_CACHE_TIMEOUT', 3600))
+    return UserPermissions(*permissions)
+
+
+def get_all_permissions() -> frozenset:
+    """
+    Every permission of the project, what a superuser is granted.
+    """
+    key = ALL_PERMISSIONS_CACHE_KEY.format(get_permissions_generation())
+    permissions = cache.get(key)
+    if permissions is None:
+        permissions = frozenset(_permission_names(
+            Permission.objects.values_list('content_type__app_label', 'codename')))
+        cache.set(key, permissions, getattr(settings, 'USER_PERMISSIONS_CACHE_TIMEOUT', 3600))
+    return permissions
+
+
+def invalidate_user_permissions(user_ids):
+    generation = get_permissions_generation()
+    cache.delete_many([USER_PERMISSIONS_CACHE_KEY.format(pk, generation) for pk in user_ids])
+
+
+def get_user_group_names(user) -> list:
+    """
+    Names of the user's groups, cached in django's cache until the membership or a group changes.
+    """
+    key = USER_GROUPS_CACHE_KEY.format(user.pk, get_permissions_generation())
+    names = cache.get(key)
+    if names is None:
+        names = list(Group.objects.filter(user=user.pk).values_list('name', flat=True))
+        cache.set(key, names, getattr(settings, 'USER_GROUPS_CACHE_TIMEOUT', 3600))
+    return names
+
+
+def invalidate_user_group_names(user_ids):
+    generation = get_permissions_generation()
+    cache.delete_many([USER_GROUPS_CACHE_KEY.format(pk, generation) for pk in user_ids])
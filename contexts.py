@@ -1,28 +1,144 @@
-try:
-    from asgiref.local import Local as LocalContext
-except ImportError:
-    from threading import local as LocalContext
+"""
+The current request, websocket or task (request, referrer, user) made available to models and signals.
+
+Backed by a single context variable: it follows asyncio tasks and `sync_to_async` threads, concurrent
+requests served by one thread or one event loop never see each other's values, and entering a context
+costs one `ContextVar.set`.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, NamedTuple, Optional
+
+_unset = object()
+
+
+class ContextState(NamedTuple):
+    request: Any = _unset
+    scope: Any = _unset
+    referrer: Any = _unset
+    user: Any = _unset
+    current_host: Any = _unset
+
+
+_state: ContextVar[Optional[ContextState]] = ContextVar('authentication_context', default=None)
+
+
+def _get_user(state: ContextState):
+    """
+    The explicitly set user, otherwise the request's authenticated user, read when first needed
+    so setting the context doesn't authenticate the request.
+    """
+    user = state.user
+    if user is _unset:
+        source = state.request if state.request is not _unset else state.scope
+        if source is _unset:
+            return _unset
+        user = source.get('user') if isinstance(source, dict) else getattr(source, 'user', None)
+        if user is None or not user.is_authenticated:
+            return _unset
+    return user
+
+
+class ContextProxy:
+    """
+    Attribute access to the current context, `context.user` raises AttributeError when it isn't set,
+    like the thread local it replaces.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        state = _state.get()
+        if state is None or name not in ContextState._fields:
+            raise AttributeError(name)
+        value = _get_user(state) if name == 'user' else getattr(state, name)
+        if value is _unset:
+            raise AttributeError(name)
+        return value
+
+    def __setattr__(self, name, value):
+        if name not in ContextState._fields:
+            raise AttributeError(name)
+        _state.set((_state.get() or ContextState())._replace(**{name: value}))
+
+    def __delattr__(self, name):
+        self.__setattr__(name, _unset)
 
 
 class CurrentApplicationContext:
-    context = LocalContext()
+    context = ContextProxy()
+
+    @staticmethod
+    def activate(request=_unset, scope=_unset, referrer=_unset, user=_unset, current_host=_unset) -> Token:
+        """
+        Replaces the current context, the returned token restores the previous one through `reset`.
+        """
+        return _state.set(ContextState(request, scope, referrer, user, current_host))
+
+    @staticmethod
+    def reset(token: Token):
+        _state.reset(token)
+
+    @classmethod
+    @contextmanager
+    def using(cls, **values):
+        token = cls.activate(**values)
+        try:
+            yield cls.context
+        finally:
+            cls.reset(token)
+
+    @staticmethod
+    def get(name: str, default=None):
+        return getattr(CurrentApplicationContext.context, name, default)
+
+    @classmethod
+    def get_user(cls):
+        return cls.get('user')
+
+    @classmethod
+    def get_referrer(cls):
+        return cls.get('referrer')
+
+    @classmethod
+    def get_request(cls):
+        return cls.get('request')
+
+    @staticmethod
+    async def aget_user():
+        """
+        The current user for async code, resolved without blocking the event loop.
+        """
+        state = _state.get()
+        if state is None:
+            return None
+        if state.user is _unset:
+            if state.request is not _unset and hasattr(state.request, 'auser'):
+                user = await state.request.auser()
+            elif state.scope is not _unset and 'auser' in state.scope:
+                user = await state.scope['auser']()
+            else:
+                user = _get_user(state)
+            return user if user is not _unset and user.is_authenticated else None
+        return state.user
 
 
 class CurrentTaskContext:
-    _local = None
-    context = None
+    """
+    Context of background tasks, shared with CurrentApplicationContext so models see the task's user.
+
+        with CurrentTaskContext.using(user=user, current_host=host):
+            ...
+    """
+    context = CurrentApplicationContext.context
 
     @classmethod
-    def init(cls):
-        cls._local = LocalContext()
-        cls._local.set('user', None)
-        cls._local.set('referrer', None)
-        cls._local.set('current_host', None)
-        cls.context = cls._local.local
+    def init(cls, user=None, referrer=None, current_host=None):
+        CurrentApplicationContext.activate(user=user, referrer=referrer, current_host=current_host)
 
     @classmethod
     def release(cls):
-        cls.context = None
-        if cls._local is not None:
-            cls._local.release()
-            cls._local = None
+        _state.set(None)
+
+    @classmethod
+    def using(cls, user=None, referrer=None, current_host=None):
+        return CurrentApplicationContext.using(user=user, referrer=referrer, current_host=current_host)
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import Throttled
+
+DEFAULT_HASHING_POOL = {
+    'ENABLED': False,
+    'KIND': 'thread',
+    'MAX_WORKERS': os.cpu_count() or 1,
+    'MAX_QUEUE': 64,
+}
+
+
+class HashingPoolFull(Throttled):
+    default_detail = _('Too many login attempts are being processed, try again shortly.')
+
+
+def _setup_worker():
+    import django
+
+    django.setup()
+
+
+class HashingPool:
+    """
+    Runs CPU bound password hashing on a thread or process pool.
+
+    At most `max_workers + max_queue` jobs are accepted, beyond that submissions fail fast with
+    HashingPoolFull (429) instead of queueing behind a login burst.
+    """
+
+    def __init__(self, kind='thread', max_workers=1, max_queue=64):
+        if kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_setup_worker)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hashing')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.rejected = 0
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingPoolFull()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_hashing_pool = None
+
+
+def get_hashing_pool():
+    """
+    Returns the process wide pool configured by `settings.PASSWORD_HASHING_POOL`, None when disabled.
+    """
+    global _hashing_pool
+    if _hashing_pool is None:
+        config = {**DEFAULT_HASHING_POOL, **getattr(settings, 'PASSWORD_HASHING_POOL', {})}
+        if not config['ENABLED']:
+            return None
+        _hashing_pool = HashingPool(kind=config['KIND'], max_workers=config['MAX_WORKERS'],
+                                    max_queue=config['MAX_QUEUE'])
+    return _hashing_pool
+
+
+def reset_hashing_pool():
+    global _hashing_pool
+    if _hashing_pool is not None:
+        _hashing_pool.shutdown()
+    _hashing_pool = None
+
+
+def run_hasher(fn, *args):
+    pool = get_hashing_pool()
+    if pool is None:
+        return fn(*args)
+    return pool.run(fn, *args)
+
+
+async def arun_hasher(fn, *args):
+    pool = get_hashing_pool()
+    if pool is None:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    return await pool.arun(fn, *args)
@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from authentication.writers import BatchedTimestampWriter
+
+DEFAULT_TOKEN_EXPIRY = {
+    'TTL': None,
+    'IDLE_TTL': None,
+    'FLUSH_INTERVAL': 60,
+    'MAX_PENDING': 5000,
+}
+
+
+def get_expiry_settings() -> dict:
+    return {**DEFAULT_TOKEN_EXPIRY, **getattr(settings, 'MULTI_TOKEN_EXPIRY', {})}
+
+
+def get_expiry_cutoffs(now=None):
+    """
+    Returns the (absolute, idle) datetimes before which a token is expired, None when not enforced.
+    """
+    config = get_expiry_settings()
+    now = now or timezone.now()
+    absolute = now - timedelta(seconds=config['TTL']) if config['TTL'] else None
+    idle = now - timedelta(seconds=config['IDLE_TTL']) if config['IDLE_TTL'] else None
+    return absolute, idle
+
+
+def token_is_expired(key, created, last_used, now=None) -> bool:
+    absolute, idle = get_expiry_cutoffs(now)
+    if absolute is not None and created < absolute:
+        return True
+    if idle is not None:
+        seen = max(filter(None, (last_used_recorder.last_seen(key), last_used, created)))
+        return seen < idle
+    return False
+
+
+class LastUsedRecorder(BatchedTimestampWriter):
+    """
+    Batched write back of `MultiToken.last_used`.
+    """
+
+    field = 'last_used'
+
+    def get_queryset(self):
+        from authentication.models import MultiToken
+
+        return MultiToken.objects.all()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        `last_used` is only needed to enforce the TTLs, nothing is recorded while both are off.
+        """
+        config = get_expiry_settings()
+        return bool(config['TTL'] or config['IDLE_TTL'])
+
+    def get_flush_limits(self):
+        config = get_expiry_settings()
+        return config['FLUSH_INTERVAL'], config['MAX_PENDING']
+
+
+last_used_recorder = LastUsedRecorder()
@@ -0,0 +1,115 @@
+"""
+Password hashers whose cost parameters come from `settings.PASSWORD_HASHER_PROFILES`.
+
+They keep django's algorithm names, replace django's hashers with them in `settings.PASSWORD_HASHERS`:
+
+    PASSWORD_HASHERS = ['authentication.hashers.ProfiledPBKDF2PasswordHasher', ...]
+    PASSWORD_HASHER_PROFILES = {'default': {'pbkdf2_iterations': 600000}, 'fast': {'pbkdf2_iterations': 100000}}
+    PASSWORD_HASHER_PROFILE = 'fast'
+
+Hashes made with other parameters are upgraded (or downgraded) on the next successful login through
+django's `must_update` mechanism.
+"""
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, Argon2PasswordHasher, check_password, \
+    make_password, identify_hasher, get_hasher
+from django.utils.crypto import get_random_string
+
+from authentication.executors import run_hasher, arun_hasher
+
+
+def get_hasher_profile() -> dict:
+    profiles = getattr(settings, 'PASSWORD_HASHER_PROFILES', {})
+    return profiles.get(getattr(settings, 'PASSWORD_HASHER_PROFILE', 'default'), {})
+
+
+class ProfiledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return get_hasher_profile().get('pbkdf2_iterations', PBKDF2PasswordHasher.iterations)
+
+
+class ProfiledArgon2PasswordHasher(Argon2PasswordHasher):
+
+    @property
+    def time_cost(self):
+        return get_hasher_profile().get('argon2_time_cost', Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return get_hasher_profile().get('argon2_memory_cost', Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return get_hasher_profile().get('argon2_parallelism', Argon2PasswordHasher.parallelism)
+
+
+@lru_cache(maxsize=8)
+def _dummy_hash(hashers: tuple, profile: tuple) -> str:
+    return make_password(get_random_string(16))
+
+
+def get_dummy_hash() -> str:
+    """
+    A hash of a random password made with the current default hasher and profile, computed once.
+    """
+    return _dummy_hash(tuple(settings.PASSWORD_HASHERS), tuple(sorted(get_hasher_profile().items())))
+
+
+def run_dummy_hasher(password: str) -> None:
+    """
+    Runs the default hasher once so a login for an unknown user costs as much as a real one (django #20760).
+    """
+    run_hasher(check_password, password, get_dummy_hash())
+
+
+async def arun_dummy_hasher(password: str) -> None:
+    await arun_hasher(check_password, password, get_dummy_hash())
+
+
+def _must_update(encoded: str) -> bool:
+    """
+    Like django's `check_password`: the hash is redone when the preferred hasher changed or its parameters did.
+    """
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != get_hasher().algorithm or hasher.must_update(encoded)
+
+
+def verify_password(user, password: str) -> bool:
+    """
+    `user.check_password` going through the hashing pool, outdated hashes are upgraded like django does.
+    """
+    if not run_hasher(check_password, password, user.password):
+        return False
+    if _must_update(user.password):
+        set_password(user, password)
+        user.save(update_fields=['password'])
+    return True
+
+
+async def averify_password(user, password: str) -> bool:
+    if not await arun_hasher(check_password, password, user.password):
+        return False
+    if _must_update(user.password):
+        await aset_password(user, password)
+        await user.asave(update_fields=['password'])
+    return True
+
+
+def set_password(user, password: str) -> None:
+    """
+    `user.set_password` going through the hashing pool.
+    """
+    user.password = run_hasher(make_password, password)
+    user._password = password
+
+
+async def aset_password(user, password: str) -> None:
+    user.password = await arun_hasher(make_password, password)
+    user._password = password
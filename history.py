@@ -0,0 +1,140 @@
+"""
+Diff-only change history: one ChangeLog row per save holding the changed fields only, buffered for the
+transaction and written with a single `bulk_create` when it commits.
+"""
+import weakref
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+
+from authentication.contexts import CurrentApplicationContext
+
+
+def get_history_user(instance=None, request=None, **kwargs):
+    """
+    `get_user` of simple_history's HistoricalRecords, the user of the current request, task or websocket.
+    """
+    user = getattr(instance, '_history_user', None)
+    if user is not None:
+        return user
+    if request is not None and getattr(request, 'user', None) is not None and request.user.is_authenticated:
+        return request.user
+    return CurrentApplicationContext.get_user()
+
+
+def snapshot(instance, fields=None) -> dict:
+    """
+    Current values of the tracked fields of `instance`, deferred fields are left out.
+    """
+    deferred = instance.get_deferred_fields()
+    return {
+        field.attname: field.value_from_object(instance)
+        for field in instance.history_fields()
+        if field.attname not in deferred and (fields is None or field.attname in fields or field.name in fields)
+    }
+
+
+def diff(old: dict, new: dict) -> dict:
+    return {name: [old.get(name), value] for name, value in new.items() if name not in old or old[name] != value}
+
+
+class PendingChangeLog:
+    """
+    ChangeLog rows of one transaction or savepoint, registered once as its `on_commit` callback.
+    """
+
+    def __init__(self, using: str):
+        self.using = using
+        self.entries = []
+
+    def __call__(self):
+        from authentication.models import ChangeLog
+
+        ChangeLog.objects.using(self.using).bulk_create(self.entries)
+
+
+class ChangeLogBuffer:
+    """
+    Holds ChangeLog rows until the running transaction commits, one `PendingChangeLog` per transaction and
+    savepoint of a connection, kept in its `changelog_buffers`. The buffer is registered with `on_commit` the
+    first time it is used and only weakly referenced otherwise: django drops the callbacks of a rolled back
+    transaction or savepoint, and the rows recorded in it go away with them. Outside of a transaction rows
+    are written right away.
+    """
+
+    def add(self, entries, using: str):
+        from authentication.models import ChangeLog
+
+        entries = list(entries)
+        if not entries:
+            return
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            ChangeLog.objects.using(using).bulk_create(entries)
+            return
+        buffers = getattr(connection, 'changelog_buffers', None)
+        if buffers is None:
+            buffers = connection.changelog_buffers = weakref.WeakValueDictionary()
+        key = tuple(connection.savepoint_ids)
+        pending = buffers.get(key)
+        if pending is None:
+            pending = buffers[key] = PendingChangeLog(using)
+            transaction.on_commit(pending, using=using)
+        pending.entries.extend(entries)
+
+
+changelog_buffer = ChangeLogBuffer()
+
+
+def make_entry(instance, action: str, changes: dict):
+    from authentication.models import ChangeLog
+
+    user = CurrentApplicationContext.get_user()
+    return ChangeLog(
+        content_type=ContentType.objects.get_for_model(instance, for_concrete_model=False),
+        object_id=str(instance.pk),
+        action=action,
+        changes=changes,
+        user_id=getattr(user, 'pk', None),
+        referrer=(CurrentApplicationContext.get_referrer() or '')[:512],
+    )
+
+
+def record_save(instance, created: bool, update_fields=None, using: str = None):
+    from authentication.models import ChangeLog
+
+    current = snapshot(instance, update_fields)
+    if created:
+        action, changes = ChangeLog.CREATE, diff({}, current)
+    else:
+        action, changes = ChangeLog.UPDATE, diff(getattr(instance, '_history_snapshot', {}), current)
+        if not changes:
+            return
+    instance._history_snapshot = {**getattr(instance, '_history_snapshot', {}), **current}
+    changelog_buffer.add([make_entry(instance, action, changes)], using or instance._state.db)
+
+
+def bulk_update_with_history(objs, fields, batch_size: int = None) -> int:
+    """
+    `bulk_update` of the objects whose `fields` changed, recording a ChangeLog row for each with one INSERT.
+    Unchanged objects are neither updated nor recorded.
+    """
+    from authentication.models import ChangeLog
+
+    changed, entries = [], []
+    for obj in objs:
+        current = snapshot(obj, fields)
+        changes = diff(getattr(obj, '_history_snapshot', {}), current)
+        if not changes:
+            continue
+        changed.append(obj)
+        entries.append(make_entry(obj, ChangeLog.UPDATE, changes))
+        obj._history_snapshot = {**getattr(obj, '_history_snapshot', {}), **current}
+    if not changed:
+        return 0
+    model = type(changed[0])
+    using = router.db_for_write(model)
+    with transaction.atomic(using=using, savepoint=False):
+        updated = model._base_manager.db_manager(using).bulk_update(changed, fields, batch_size=batch_size)
+        changelog_buffer.add(entries, using)
+    return updated
@@ -0,0 +1,50 @@
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import select_template
+from django.utils import translation
+from django.utils.translation import gettext as _
+
+
+class PasswordResetEmailRenderer:
+    """
+    Builds password reset emails from a template loaded and compiled once per language.
+
+    `mail/<language>/password_reset.html` is used when it exists, `mail/password_reset.html` otherwise.
+    """
+
+    template_name = "mail/password_reset.html"
+    from_email = "contact@theschool.pro"
+
+    def __init__(self):
+        self._templates = {}
+
+    def get_template(self, language: str):
+        template = self._templates.get(language)
+        if template is None:
+            directory, name = self.template_name.rsplit('/', 1)
+            template = select_template([f"{directory}/{language}/{name}", self.template_name])
+            self._templates[language] = template
+        return template
+
+    def build_messages(self, verifications, language: str = None) -> list:
+        """
+        Renders one EmailMultiAlternatives per verification, ready for a single `connection.send_messages`.
+        """
+        language = language or translation.get_language() or 'en'
+        template = self.get_template(language)
+        messages = []
+        with translation.override(language):
+            subject = _('Password reset')
+            for verification in verifications:
+                link = verification.reset_link
+                html = template.render({"link": link, "otp": verification.raw_otp})
+                text_content = f'You requested a password reset, please follow the link {link}'
+                message = EmailMultiAlternatives(subject, text_content, self.from_email, [verification.email])
+                message.attach_alternative(html, "text/html")
+                messages.append(message)
+        return messages
+
+    def clear(self):
+        self._templates.clear()
+
+
+password_reset_renderer = PasswordResetEmailRenderer()
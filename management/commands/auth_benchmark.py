@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Runs the authentication app micro benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f"Any of {', '.join(sorted(BENCHMARKS))}, all by default.")
+        parser.add_argument('--count', type=int, default=None)
+
+    def handle(self, *args, names=None, count=None, **options):
+        unknown = set(names or ()) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        for name in names or sorted(BENCHMARKS):
+            kwargs = {'count': count} if count else {}
+            result = BENCHMARKS[name](**kwargs)
+            self.stdout.write(name)
+            for key, value in result.items():
+                self.stdout.write(f"  {key}: {value}")
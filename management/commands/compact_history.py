@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from authentication.models import ChangeLog
+
+
+class Command(BaseCommand):
+    help = "Merges old change log entries into one per object and deletes the ones past retention, in small chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compact-after-days', type=int,
+                            default=getattr(settings, 'CHANGE_LOG_COMPACT_AFTER_DAYS', 30))
+        parser.add_argument('--keep-days', type=int, default=getattr(settings, 'CHANGE_LOG_RETENTION_DAYS', 365))
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to sleep between chunks.")
+
+    def handle(self, *args, compact_after_days=30, keep_days=365, batch_size=1000, pause=0, **options):
+        now = timezone.now()
+        deleted = ChangeLog.objects.purge(now - timedelta(days=keep_days), batch_size=batch_size, pause=pause)
+        merged = ChangeLog.objects.compact(now - timedelta(days=compact_after_days), batch_size=batch_size)
+        self.stdout.write(f"Deleted {deleted} expired and merged {merged} compacted change log entries.")
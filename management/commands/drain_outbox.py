@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentication.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = "Delivers queued verification emails and SMS in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help="Keep draining, sleeping when the outbox is empty.")
+        parser.add_argument('--interval', type=float, default=2)
+
+    def handle(self, *args, batch_size=None, loop=False, interval=2, **options):
+        while True:
+            handled = drain_outbox(batch_size=batch_size)
+            if handled:
+                self.stdout.write(f"Handled {handled} messages.")
+                continue
+            if not loop:
+                return
+            time.sleep(interval)
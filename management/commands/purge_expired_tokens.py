@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from authentication.models import MultiToken
+
+
+class Command(BaseCommand):
+    help = "Deletes MultiTokens past their absolute or idle TTL, in small chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to sleep between chunks.")
+
+    def handle(self, *args, batch_size=1000, pause=0, **options):
+        deleted = MultiToken.objects.purge_expired(batch_size=batch_size, pause=pause)
+        self.stdout.write(f"Deleted {deleted} expired tokens.")
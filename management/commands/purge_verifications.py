@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentication.otp import get_otp_store
+
+
+class Command(BaseCommand):
+    help = "Deletes used and timed out password reset verifications, in small chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to sleep between chunks.")
+
+    def handle(self, *args, batch_size=1000, pause=0, **options):
+        store = get_otp_store()
+        deleted = 0
+        while True:
+            pks = list(store.stale().values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            deleted += store.model.objects.filter(pk__in=pks).delete()[0]
+            if pause:
+                time.sleep(pause)
+        self.stdout.write(f"Deleted {deleted} verifications.")
@@ -0,0 +1,40 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from authentication.models import RollupModel
+
+
+class Command(BaseCommand):
+    help = "Refreshes rollup tables, only the buckets whose source rows changed since the last refresh by default."
+
+    def add_arguments(self, parser):
+        parser.add_argument('rollups', nargs='*', help="Rollup model labels (app_label.ModelName), all by default.")
+        parser.add_argument('--full', action='store_true', help="Recompute every bucket.")
+        parser.add_argument('--start', help="Recompute the buckets from this date (YYYY-MM-DD).")
+        parser.add_argument('--end', help="Recompute the buckets up to this date (YYYY-MM-DD).")
+
+    def handle(self, *args, rollups=(), full=False, start=None, end=None, **options):
+        try:
+            models = [apps.get_model(label) for label in rollups]
+        except (LookupError, ValueError) as exc:
+            raise CommandError(exc)
+        models = models or [model for model in apps.get_models() if issubclass(model, RollupModel)]
+        start, end = self.parse(start, '--start'), self.parse(end, '--end')
+        for model in models:
+            if not issubclass(model, RollupModel):
+                raise CommandError(f"{model._meta.label} is not a RollupModel.")
+            if full or start or end:
+                written = model.objects.refresh(start, end)
+            else:
+                written = model.objects.refresh_incremental()
+            self.stdout.write(f"{model._meta.label}: {written} rows refreshed.")
+
+    @staticmethod
+    def parse(value, option):
+        if value is None:
+            return None
+        parsed = parse_date(value)
+        if parsed is None:
+            raise CommandError(f"{option} expects a YYYY-MM-DD date.")
+        return parsed
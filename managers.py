@@ -1,27 +1,375 @@
-from django.db.models import Manager
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Manager, Prefetch, QuerySet, Q, Window
+from django.db.models.functions import RowNumber
+
+ACCESS_CODE_MISS_KEY = 'access-code-miss:{}'
+# below SQLite's 999 query parameters.
+USERS_PER_QUERY = 500
+
+
+def top_n_per_group(queryset, partition_by: str, n: int, order_by=None):
+    """
+    Rows of `queryset` ranking in the first `n` of their `partition_by` group, in one query
+    (`ROW_NUMBER() OVER (PARTITION BY ...)`). The rank is exposed as `group_rank`.
+    """
+    order_by = order_by or queryset.model._meta.ordering or ['pk']
+    return queryset.annotate(
+        group_rank=Window(RowNumber(), partition_by=F(partition_by), order_by=list(order_by))
+    ).filter(group_rank__lte=n).order_by(partition_by, 'group_rank')
+
+
+def prefetch_top_n(model, lookup: str, n: int, queryset=None, order_by=None, to_attr=None) -> Prefetch:
+    """
+    Prefetches at most `n` rows of the reverse foreign key `lookup` of `model` per instance,
+    with one query whatever the number of instances.
+    """
+    related = model._meta.get_field(lookup)
+    if queryset is None:
+        queryset = related.related_model._default_manager.all()
+    return Prefetch(lookup, queryset=top_n_per_group(queryset, related.field.name, n, order_by), to_attr=to_attr)
 
 
 class CustomCategoryManager(Manager):
 
     def category_with_3_products(self):
+        """
+        (category, first 3 products) of every sub category with more than 3 products, in three queries.
+
+        Sub categories of the visible categories are all considered, hidden ones included, their products
+        are counted and listed among the visible ones only.
+        """
+        sub_model = self.model._meta.get_field('sub_categories').related_model
+        subs = sub_model._base_manager.annotate(product_count=Count('products', filter=Q(products__visible=True))) \
+            .filter(product_count__gt=3) \
+            .prefetch_related(prefetch_top_n(sub_model, 'products', 3, to_attr='top_products'))
         categories = []
-        for category in self.filter(visible=True):
+        for category in self.filter(visible=True).prefetch_related(Prefetch('sub_categories', queryset=subs)):
             for sub in category.sub_categories.all():
-                if sub.products.count() > 3:
-                    categories.append((category, sub.products.all()[0:3]))
+                categories.append((category, sub.top_products))
         return categories
 
     def with_sub_cats(self):
+        """
+        Visible categories with their visible sub categories, in two queries.
+        """
+        sub_model = self.model._meta.get_field('sub_categories').related_model
+        subs = sub_model._default_manager.filter(visible=True)
         categories = []
-        for category in self.filter(visible=True):
+        for category in self.filter(visible=True).prefetch_related(
+                Prefetch('sub_categories', queryset=subs, to_attr='visible_sub_categories')):
             categories.append(dict(id=category.id, name=category.name,
-                                   subs=list(category.sub_categories.filter(visible=True).values('id', 'name'))))
+                                   subs=[dict(id=sub.id, name=sub.name) for sub in category.visible_sub_categories]))
         return categories
 
 
-class DeletableManager(Manager):
+class SyncQuerySet(QuerySet):
+
+    def changed_since(self, since=None, after=None):
+        """
+        Rows created or updated after the (`since`, `after`) position, ordered by (updated_at, pk), the feed read by
+        incremental sync clients. `after` is the primary key of the last row read at `since`.
+        """
+        queryset = self.order_by('updated_at', 'pk')
+        if since is None:
+            return queryset
+        if after is None:
+            return queryset.filter(updated_at__gt=since)
+        return queryset.filter(Q(updated_at__gt=since) | Q(updated_at=since, pk__gt=after))
+
+
+class SyncManager(Manager.from_queryset(SyncQuerySet)):
+    pass
+
+
+class DeletableQuerySet(SyncQuerySet):
+
     def visible(self):
         return self.filter(visible=True)
 
     def invisible(self):
         return self.filter(visible=False)
+
+    def soft_delete(self) -> int:
+        """
+        Hides the rows with a single UPDATE of `visible` and `updated_at`, returns the number of hidden rows.
+        """
+        from django.utils import timezone
+
+        return self.filter(visible=True).update(visible=False, updated_at=timezone.now())
+
+    soft_delete.alters_data = True
+
+    def restore(self) -> int:
+        from django.utils import timezone
+
+        return self.filter(visible=False).update(visible=True, updated_at=timezone.now())
+
+    restore.alters_data = True
+
+    def delete(self):
+        """
+        Soft deletes the rows, same return value as `QuerySet.delete`. Use `force_delete` to remove them.
+        """
+        hidden = self.soft_delete()
+        return hidden, {self.model._meta.label: hidden}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def hard_delete(self):
+        return super().delete()
+
+    hard_delete.alters_data = True
+    hard_delete.queryset_only = True
+
+    def force_delete(self, batch_size: int = 1000, pause: float = 0) -> int:
+        """
+        Removes the rows in chunks of `batch_size`, each chunk being its own short DELETE
+        (dependent rows and deletion signals included).
+
+        Returns the number of removed rows.
+        """
+        deleted = 0
+        while True:
+            pks = list(self.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            count, _ = self.model._base_manager.using(self.db).filter(pk__in=pks).delete()
+            deleted += count
+            if pause:
+                time.sleep(pause)
+
+    force_delete.alters_data = True
+
+
+class DeletableManager(Manager.from_queryset(DeletableQuerySet)):
+    """
+    Visible rows only, `all_objects` reaches the soft deleted ones.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(visible=True)
+
+    def invisible(self):
+        return super().get_queryset().filter(visible=False)
+
+
+class ChangeLogQuerySet(QuerySet):
+
+    def for_object(self, instance):
+        from django.contrib.contenttypes.models import ContentType
+
+        content_type = ContentType.objects.get_for_model(instance, for_concrete_model=False)
+        return self.filter(content_type=content_type, object_id=str(instance.pk))
+
+    def purge(self, before, batch_size: int = 1000, pause: float = 0) -> int:
+        """
+        Deletes the entries older than `before` in chunks of `batch_size`, returns the number of deleted entries.
+        """
+        deleted = 0
+        while True:
+            pks = list(self.filter(created_at__lt=before).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += self.model._base_manager.using(self.db).filter(pk__in=pks).delete()[0]
+            if pause:
+                time.sleep(pause)
+
+    def compact(self, before, batch_size: int = 1000) -> int:
+        """
+        Merges the entries older than `before` of every object into one entry holding each changed field's
+        first old and last new value. Returns the number of removed entries.
+        """
+        from django.db import transaction
+
+        removed = 0
+        while True:
+            groups = list(
+                self.filter(created_at__lt=before).order_by().values('content_type', 'object_id')
+                .annotate(entries=Count('pk')).filter(entries__gt=1)[:batch_size]
+            )
+            if not groups:
+                return removed
+            for group in groups:
+                entries = list(self.filter(created_at__lt=before, content_type=group['content_type'],
+                                           object_id=group['object_id']).order_by('created_at', 'pk'))
+                merged = {}
+                for entry in entries:
+                    for name, (old, new) in entry.changes.items():
+                        merged[name] = [merged[name][0] if name in merged else old, new]
+                last = entries[-1]
+                last.changes = merged
+                if entries[0].action == self.model.CREATE and last.action != self.model.DELETE:
+                    last.action = self.model.CREATE
+                with transaction.atomic(using=self.db):
+                    last.save(update_fields=['changes', 'action'])
+                    removed += self.model._base_manager.using(self.db) \
+                        .filter(pk__in=[entry.pk for entry in entries[:-1]]).delete()[0]
+
+
+class ChangeLogManager(Manager.from_queryset(ChangeLogQuerySet)):
+    pass
+
+
+class RollupQuerySet(QuerySet):
+
+    def between(self, start, end):
+        """
+        Rollup rows of the buckets starting in [start, end).
+        """
+        return self.filter(bucket__gte=start, bucket__lt=end)
+
+    def refresh(self, start=None, end=None) -> int:
+        from authentication.reports import refresh_rollup
+
+        return refresh_rollup(self.model, start, end)
+
+    def refresh_incremental(self) -> int:
+        from authentication.reports import refresh_rollup_incremental
+
+        return refresh_rollup_incremental(self.model)
+
+
+class RollupManager(Manager.from_queryset(RollupQuerySet)):
+    pass
+
+
+class MultiTokenQuerySet(QuerySet):
+
+    def for_users(self, users):
+        """
+        Tokens of `users`, a queryset of users (sent as a subquery, any size) or instances / primary keys
+        (sent as query parameters, keep lists under `USERS_PER_QUERY`).
+        """
+        if isinstance(users, QuerySet):
+            return self.filter(user__in=users.values('pk'))
+        return self.filter(user_id__in=[getattr(user, 'pk', user) for user in users])
+
+    def for_device(self, device_name: str):
+        return self.filter(device_name=device_name)
+
+    def older_than(self, when):
+        return self.filter(created__lt=when)
+
+    def expired(self, now=None):
+        """
+        Tokens past the absolute or the idle TTL of `settings.MULTI_TOKEN_EXPIRY`.
+        """
+        from authentication.expiry import get_expiry_cutoffs
+
+        absolute, idle = get_expiry_cutoffs(now)
+        if absolute is None and idle is None:
+            return self.none()
+        condition = Q()
+        if absolute is not None:
+            condition |= Q(created__lt=absolute)
+        if idle is not None:
+            condition |= Q(last_used__lt=idle) | Q(last_used__isnull=True, created__lt=idle)
+        return self.filter(condition)
+
+    def purge_expired(self, batch_size: int = 1000, pause: float = 0) -> int:
+        """
+        Deletes expired tokens in chunks of `batch_size`, each chunk being its own short DELETE dropped
+        from the token cache at once.
+
+        Returns the number of deleted tokens.
+        """
+        deleted = 0
+        while True:
+            keys = list(self.expired().values_list('key', flat=True)[:batch_size])
+            if not keys:
+                return deleted
+            deleted += self._delete_keys(keys)
+            self._invalidate(keys, batch_size)
+            if pause:
+                time.sleep(pause)
+
+    def issue(self, users, device_name: str = '', batch_size: int = 1000):
+        """
+        Creates one token per user (instances or primary keys) with batched INSERTs.
+        """
+        tokens = [
+            self.model(key=self.model.generate_key(), user_id=getattr(user, 'pk', user), device_name=device_name)
+            for user in users
+        ]
+        return self.bulk_create(tokens, batch_size=batch_size)
+
+    def revoke(self, batch_size: int = 500) -> int:
+        """
+        Deletes the tokens of the queryset in chunks of `batch_size` keys and drops each chunk from the token cache
+        once deleted, a token cached while the chunk is deleted is invalidated with it.
+
+        Returns the number of deleted tokens.
+        """
+        keys = list(self.values_list('key', flat=True).iterator(chunk_size=batch_size))
+        deleted = 0
+        for start in range(0, len(keys), batch_size):
+            chunk = keys[start:start + batch_size]
+            deleted += self._delete_keys(chunk)
+            self._invalidate(chunk, batch_size)
+        return deleted
+
+    def _delete_keys(self, keys) -> int:
+        # nothing references tokens, a plain DELETE skips the per row post_delete cache invalidation.
+        return self.model._base_manager.using(self.db).filter(key__in=keys)._raw_delete(self.db)
+
+    def _invalidate(self, keys, batch_size: int):
+        from django.db import connections, transaction
+        from authentication.caches import get_token_cache
+
+        token_cache = get_token_cache()
+        if token_cache is None:
+            return
+        for start in range(0, len(keys), batch_size):
+            token_cache.delete_many(keys[start:start + batch_size])
+        if connections[self.db].in_atomic_block:
+            # a request may cache the still committed row until the transaction commits.
+            transaction.on_commit(lambda: self._invalidate(keys, batch_size), using=self.db)
+
+
+class MultiTokenManager(Manager.from_queryset(MultiTokenQuerySet)):
+    pass
+
+
+class AccessCodeManager(Manager):
+
+    def resolve_user(self, access_code: str):
+        """
+        Returns the user owning the access code, None when unknown or shared by several users.
+
+        Unknown digests are remembered for `ACCESS_CODE_MISS_CACHE_TIMEOUT` seconds, repeated bad codes
+        are rejected without a query. Digests made with one of SECRET_KEY_FALLBACKS are matched and
+        rewritten under SECRET_KEY.
+        """
+        from authentication.utils import access_code_digests
+
+        digests = access_code_digests(access_code)
+        miss_key = ACCESS_CODE_MISS_KEY.format(digests[0])
+        if cache.get(miss_key):
+            return None
+        matches = list(self.select_related('user').filter(digest__in=digests)[:2])
+        if not matches:
+            cache.set(miss_key, True, getattr(settings, 'ACCESS_CODE_MISS_CACHE_TIMEOUT', 60))
+            return None
+        if len(matches) > 1:
+            return None
+        match = matches[0]
+        if match.digest != digests[0]:
+            self.filter(pk=match.pk).update(digest=digests[0])
+        return match.user
+
+
+class OutboxMessageQuerySet(QuerySet):
+
+    def due(self, now=None):
+        from django.utils import timezone
+
+        return self.filter(sent_at__isnull=True, given_up=False,
+                           next_attempt_at__lte=now or timezone.now()).order_by('next_attempt_at')
+
+
+class OutboxMessageManager(Manager.from_queryset(OutboxMessageQuerySet)):
+    pass
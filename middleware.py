@@ -1,65 +1,112 @@
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
 from rest_framework import exceptions
 
 from authentication.contexts import CurrentApplicationContext
 
 
-class CurrentContextMiddleware(MiddlewareMixin):
+class CurrentContextMiddleware:
     """
     Expose request to other layers of the application (models, signals... etc).
 
-    This middleware sets request as a local context/thread variable, making it
-    available to the model-level utilities to allow tracking of the authenticated user.
+    This middleware sets request as the current context, making it available to the model-level
+    utilities to allow tracking of the authenticated user. Works under WSGI and ASGI.
     """
+    sync_capable = True
+    async_capable = True
 
-    def process_request(self, request):
-        CurrentApplicationContext.context.request = request
-        CurrentApplicationContext.context.referrer = request.META.get("HTTP_REFERER")
-        if request.user.is_authenticated:
-            CurrentApplicationContext.context.user = request.user
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = CurrentApplicationContext.activate(request=request, referrer=request.META.get("HTTP_REFERER"))
+        try:
+            return self.get_response(request)
+        finally:
+            CurrentApplicationContext.reset(token)
+
+    async def __acall__(self, request):
+        token = CurrentApplicationContext.activate(request=request, referrer=request.META.get("HTTP_REFERER"))
+        try:
+            return await self.get_response(request)
+        finally:
+            CurrentApplicationContext.reset(token)
+
+
+class CurrentContextSocketMiddleware:
+    """
+    CurrentContextMiddleware for websocket connections, place it inside DRFTokenSocketMiddleware
+    so the context sees the connection's user.
+    """
+
+    def __init__(self, app):
+        self.app = app
 
-    def process_response(self, request, response):
-        if hasattr(CurrentApplicationContext.context, "request"):
-            del CurrentApplicationContext.context.request
-        if hasattr(CurrentApplicationContext.context, "referrer"):
-            del CurrentApplicationContext.context.referrer
-        if hasattr(CurrentApplicationContext.context, "user"):
-            del CurrentApplicationContext.context.user
-        return response
+    async def __call__(self, scope, receive, send, *args, **kwargs):
+        referrer = dict(scope.get('headers', ())).get(b'referer')
+        token = CurrentApplicationContext.activate(scope=scope, referrer=referrer and referrer.decode('latin1'))
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            CurrentApplicationContext.reset(token)
+
+
+def get_token_user(request, session_user=None):
+    from authentication.authentication import MultiTokenAuthentication
+    from django.contrib.auth.models import AnonymousUser
+    if session_user is not None and session_user.is_authenticated:
+        return session_user
+    try:
+        result = MultiTokenAuthentication().authenticate(request)
+    except exceptions.AuthenticationFailed:
+        result = None
+    if result:
+        user, token = result
+        return user
+    return AnonymousUser()
 
 
 class DRFTokenAuthMiddleware(MiddlewareMixin):
+    """
+    Authenticates MultiToken requests for plain django views.
+
+    `request.user` is resolved on first access only, DRF's MultiTokenAuthentication reuses the outcome
+    so a request costs at most one token lookup.
+    """
 
     def process_request(self, request):
-        from authentication.authentication import MultiTokenAuthentication
-        from django.contrib.auth.models import AnonymousUser
-        if request.user.is_authenticated:
-            return
-        try:
-            user = AnonymousUser()
-            result = MultiTokenAuthentication().authenticate(request)
-            if result:
-                user, token = result
-            request.user = user
-        except exceptions.AuthenticationFailed:
-            pass
+        request.user = SimpleLazyObject(partial(get_token_user, request, getattr(request, 'user', None)))
 
 
 class DRFTokenSocketMiddleware:
+    """
+    Authenticates websocket connections with a MultiToken sent in the `Authorization` query parameter.
+
+    The token is resolved before the consumer runs, concurrent connections with the same token share one
+    lookup through `websocket_token_resolver`. For a cached token `scope['user']` is a CachedTokenUser:
+    pk, is_active and is_authenticated cost nothing, async consumers needing other fields await
+    `scope['auser']()` which loads the user row once.
+    """
 
     def __init__(self, app):
         self.app = app
 
     async def __call__(self, scope, receive, send, *args, **kwargs):
-        from authentication.authentication import WebsocketMultiTokenAuthentication
+        from authentication.authentication import websocket_token_resolver
         from django.contrib.auth.models import AnonymousUser
         scope = dict(scope)
         try:
-            user = AnonymousUser()
-            result = await WebsocketMultiTokenAuthentication().authenticate_websocket(scope)
-            if result:
-                user, token = result
-            scope['user'] = user
+            key = await websocket_token_resolver.authentication.get_token_key(scope)
         except exceptions.AuthenticationFailed:
-            scope['user'] = AnonymousUser()
+            key = None
+        user = AnonymousUser() if key is None else await websocket_token_resolver.resolve_user(key)
+        scope['user'] = user
+        scope['auser'] = partial(websocket_token_resolver.aload_user, user)
         return await self.app(scope, receive, send)
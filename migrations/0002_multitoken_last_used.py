@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='multitoken',
+            name='last_used',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Last used'),
+        ),
+        migrations.AddIndex(
+            model_name='multitoken',
+            index=models.Index(fields=['created'], name='authentication_mt_created_idx'),
+        ),
+    ]
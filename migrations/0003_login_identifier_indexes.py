@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import migrations, models
+from django.db.models.functions import Upper
+
+
+def get_login_indexes(user_model):
+    """
+    Indexes backing PhoneBackend's lookups that the user model doesn't declare itself.
+    """
+    indexes = []
+    try:
+        phone = user_model._meta.get_field('phone')
+    except FieldDoesNotExist:
+        pass
+    else:
+        if not (phone.db_index or phone.unique):
+            indexes.append(models.Index(fields=['phone'], name='authentication_user_phone_idx'))
+    try:
+        user_model._meta.get_field('email')
+    except FieldDoesNotExist:
+        pass
+    else:
+        indexes.append(models.Index(Upper('email'), name='authentication_email_upper_idx'))
+    return indexes
+
+
+def add_login_indexes(apps, schema_editor):
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    for index in get_login_indexes(user_model):
+        schema_editor.add_index(user_model, index)
+
+
+def remove_login_indexes(apps, schema_editor):
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    for index in get_login_indexes(user_model):
+        schema_editor.remove_index(user_model, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('authentication', '0002_multitoken_last_used'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_login_indexes, remove_login_indexes),
+    ]
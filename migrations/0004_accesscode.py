@@ -0,0 +1,47 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import migrations, models
+
+from authentication.utils import access_code_digest
+
+
+def populate_digests(apps, schema_editor):
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    access_code_model = apps.get_model('authentication', 'AccessCode')
+    try:
+        user_model._meta.get_field('access_code')
+    except FieldDoesNotExist:
+        return
+    users = user_model._default_manager.exclude(access_code__isnull=True).exclude(access_code='')
+    batch = []
+    for pk, access_code in users.values_list('pk', 'access_code').iterator(chunk_size=2000):
+        batch.append(access_code_model(user_id=pk, digest=access_code_digest(access_code)))
+        if len(batch) >= 2000:
+            access_code_model.objects.bulk_create(batch)
+            batch = []
+    access_code_model.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('authentication', '0003_login_identifier_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=64, verbose_name='digest')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hashed_access_code', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Access code',
+                'verbose_name_plural': 'Access codes',
+            },
+        ),
+        migrations.RunPython(populate_digests, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,22 @@
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import checks
 from django.core.mail import EmailMultiAlternatives
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
-from django.db.models import Func
-from django.template.loader import render_to_string
+from django.db.models import functions
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from rest_framework.authtoken.models import Token
 from simple_history.models import HistoricalRecords
 
-from authentication.utils import generate_otp
-from authentication.managers import DeletableManager
+from authentication.history import changelog_buffer, get_history_user, make_entry, record_save, snapshot
+from authentication.mail import password_reset_renderer
+from authentication.otp import get_otp_store, generate_unique_otps
+from authentication.utils import unknown_otp_digest
+from authentication.managers import DeletableManager, DeletableQuerySet, MultiTokenManager, AccessCodeManager, \
+    OutboxMessageManager, ChangeLogManager, SyncManager, RollupManager
 
 User = get_user_model()
 do_nothing = models.DO_NOTHING
@@ -21,47 +29,146 @@ class MultiToken(Token):
         on_delete=models.CASCADE, verbose_name="User"
     )
     device_name = models.CharField(max_length=255, blank=True)
+    last_used = models.DateTimeField(_("Last used"), null=True, blank=True, db_index=True)
+
+    objects = MultiTokenManager()
+
+    class Meta(Token.Meta):
+        indexes = [
+            models.Index(fields=['created'], name='authentication_mt_created_idx'),
+        ]
+
+
+class AccessCode(models.Model):
+    """
+    Keyed digest of a user's access code, the plain code never needs to be queried.
+    """
+    user = models.OneToOneField(
+        get_user_model(), related_name='hashed_access_code',
+        on_delete=models.CASCADE, verbose_name="User"
+    )
+    # not unique, users may pick the same code, such a code then logs nobody in.
+    digest = models.CharField(_("digest"), max_length=64, db_index=True)
+
+    objects = AccessCodeManager()
+
+    class Meta:
+        verbose_name = _("Access code")
+        verbose_name_plural = _("Access codes")
+
+
+class OutboxMessage(models.Model):
+    EMAIL = 'email'
+    SMS = 'sms'
+    CHANNELS = ((EMAIL, _("Email")), (SMS, _("SMS")))
+
+    channel = models.CharField(_("channel"), max_length=10, choices=CHANNELS)
+    recipient = models.CharField(_("recipient"), max_length=254)
+    # plain OTP to deliver, only kept until the message is sent.
+    otp = models.CharField(max_length=32, blank=True)
+    verification_model = models.CharField(max_length=100)
+    verification_id = models.PositiveBigIntegerField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    given_up = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OutboxMessageManager()
+
+    class Meta:
+        verbose_name = _("Outbox message")
+        verbose_name_plural = _("Outbox messages")
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(sent_at__isnull=True, given_up=False),
+                         name='authentication_outbox_due_idx'),
+        ]
 
 
 class Verification(models.Model):
+    """
+    Password reset request, the OTP itself is only known right after it is generated (`raw_otp`),
+    the database keeps its digest, see `authentication.otp`.
+    """
     email = models.EmailField(_("email address"), blank=True, null=True)
     phone = models.CharField(_("phone"), max_length=150, null=True, blank=True)
-    otp = models.TextField(max_length=10, unique=True, default=generate_otp, db_index=True)
+    otp = models.CharField(max_length=64, unique=True, editable=False, default=unknown_otp_digest)
     expired = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # uses of the OTP, see `authentication.otp`.
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    raw_otp = None
+
+    def save(self, *args, **kwargs):
+        new_otp = self._state.adding and self.raw_otp is None
+        if new_otp:
+            self.set_otp()
+        super().save(*args, **kwargs)
+        if new_otp:
+            get_otp_store().issue(self)
+
+    def set_otp(self) -> None:
+        [(self.raw_otp, self.otp)] = generate_unique_otps(1, model=type(self))
+        self.created_at = timezone.now()
+        self.attempts = 0
+
+    def rotate_otp(self) -> None:
+        """
+        Replaces the OTP of a saved verification, the previous one stops working.
+        """
+        previous = self.otp
+        self.set_otp()
+        type(self).objects.filter(pk=self.pk).update(otp=self.otp, created_at=self.created_at, attempts=0)
+        store = get_otp_store()
+        store.forget(previous)
+        store.issue(self)
 
     def send(self) -> None:
+        """
+        Queues the verification for delivery, see `authentication.outbox`.
+        """
         if self.expired:
             return
 
+        if self.raw_otp is None:
+            self.rotate_otp()
+
+        messages = []
         if self.email and 'dummy' not in self.email:
-            pass
+            messages.append(OutboxMessage(channel=OutboxMessage.EMAIL, recipient=self.email, otp=self.raw_otp,
+                                          verification_model=self._meta.label_lower, verification_id=self.pk))
 
         if self.phone:
-            pass
+            messages.append(OutboxMessage(channel=OutboxMessage.SMS, recipient=self.phone, otp=self.raw_otp,
+                                          verification_model=self._meta.label_lower, verification_id=self.pk))
+        OutboxMessage.objects.bulk_create(messages)
 
     @property
     def reset_link(self) -> str:
-        return f"https://app.theschool.pro/password/reset/?otp={self.otp}"
+        return f"https://app.theschool.pro/password/reset/?otp={self.raw_otp}"
 
     def build_email(self) -> EmailMultiAlternatives:
-        invitation_html = render_to_string("mail/password_reset.html",
-                                           {"link": self.reset_link, "otp": self.otp})
-        text_content = f'You requested a password reset, please follow the link {self.reset_link}'
-        msg = EmailMultiAlternatives(_('Password reset'), text_content, "contact@theschool.pro",
-                                     [self.email])
-        msg.attach_alternative(invitation_html, "text/html")
-        return msg
+        return password_reset_renderer.build_messages([self])[0]
 
     def build_sms(self) -> str:
 
         sms = f"Vous avez demander la reinitialisation de votre mot de passe, votre code est" \
-              f" :\n{self.otp} \n"
+              f" :\n{self.raw_otp} \n"
         return sms
 
     class Meta:
         verbose_name = _("Verification")
         verbose_name_plural = _("Verifications")
         abstract = True
+        # at most one active verification per email / phone, lets the reset request get_or_create safely.
+        constraints = [
+            models.UniqueConstraint(fields=['email'], condition=models.Q(expired=False),
+                                    name='%(app_label)s_%(class)s_active_email'),
+            models.UniqueConstraint(fields=['phone'], condition=models.Q(expired=False),
+                                    name='%(app_label)s_%(class)s_active_phone'),
+        ]
 
 class BaseModel(models.Model):
     """
@@ -74,16 +181,109 @@ class BaseModel(models.Model):
         abstract = True
 
 
+def sync_index(name: str = '%(class)s_sync_idx') -> models.Index:
+    """
+    Composite (updated_at, id) index backing `changed_since` feeds.
+    """
+    return models.Index(fields=['updated_at', 'id'], name=name)
+
+
+class SyncableModel(BaseModel):
+    """
+    Base Model with an indexed `changed_since` feed for incremental sync clients.
+
+    Soft deletable models list DeletableModel first to keep its managers and inherit this Meta:
+
+        class Lesson(DeletableModel, SyncableModel):
+            class Meta(SyncableModel.Meta):
+                pass
+    """
+    objects = SyncManager()
+
+    class Meta:
+        abstract = True
+        indexes = [sync_index()]
+
+
 class HistoryModel(BaseModel):
     """
     Base Model with history.
     """
-    history = HistoricalRecords(inherit=True)
+    history = HistoricalRecords(inherit=True, get_user=get_history_user)
+
+    class Meta:
+        abstract = True
+
+
+class ChangeLog(models.Model):
+    """
+    Diff-only history entry of a DiffHistoryModel, `changes` maps each changed field to [old, new].
+    """
+    CREATE = '+'
+    UPDATE = '~'
+    DELETE = '-'
+    ACTIONS = ((CREATE, _("Created")), (UPDATE, _("Changed")), (DELETE, _("Deleted")))
+
+    content_type = models.ForeignKey(ContentType, on_delete=cascade, related_name='+')
+    object_id = models.CharField(max_length=64)
+    action = models.CharField(_("action"), max_length=1, choices=ACTIONS)
+    changes = models.JSONField(_("changes"), default=dict, encoder=DjangoJSONEncoder)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
+                             db_constraint=False, verbose_name="User")
+    referrer = models.CharField(_("referrer"), max_length=512, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = ChangeLogManager()
+
+    class Meta:
+        verbose_name = _("Change log")
+        verbose_name_plural = _("Change logs")
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', 'created_at'], name='authentication_chlog_obj_idx'),
+            models.Index(fields=['created_at'], name='authentication_chlog_at_idx'),
+        ]
+
+
+class DiffHistoryModel(BaseModel):
+    """
+    Base Model with diff-only history: saves record the changed fields in ChangeLog when the transaction commits,
+    use `bulk_update_with_history` for bulk updates.
+    """
+    history_excluded_fields = ('created_at', 'updated_at')
+
+    @classmethod
+    def history_fields(cls):
+        return [field for field in cls._meta.concrete_fields
+                if not field.primary_key and field.name not in cls.history_excluded_fields]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._history_snapshot = snapshot(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        record_save(self, created, kwargs.get('update_fields'), kwargs.get('using'))
+
+    def delete(self, using=None, keep_parents=False):
+        entry = make_entry(self, ChangeLog.DELETE, {})
+        deleted = super().delete(using=using, keep_parents=keep_parents)
+        changelog_buffer.add([entry], using or self._state.db)
+        return deleted
 
     class Meta:
         abstract = True
 
 
+def visible_index(*fields: str, name: str) -> models.Index:
+    """
+    Partial index on `fields` of the visible rows only, listings of DeletableModel never scan tombstones.
+    """
+    return models.Index(fields=list(fields), condition=models.Q(visible=True), name=name)
+
+
 class DeletableModel(BaseModel):
     """
     Soft delete Base model
@@ -91,42 +291,115 @@ class DeletableModel(BaseModel):
     visible = models.BooleanField(default=True)
 
     objects = DeletableManager()
+    all_objects = DeletableQuerySet.as_manager()
 
     def delete(self, using=None, keep_parents=False):
         self.visible = False
-        self.save()
-        # TODO: 26 / 06 / 2022 add force delete
+        self.save(using=using, update_fields=['visible', 'updated_at'])
+
+    def restore(self, using=None):
+        self.visible = True
+        self.save(using=using, update_fields=['visible', 'updated_at'])
+
+    def hard_delete(self, using=None, keep_parents=False):
+        return super().delete(using=using, keep_parents=keep_parents)
 
     class Meta:
         abstract = True
 
 
-class Round(Func):
+class RollupModel(models.Model):
     """
-    aggregation function rounds the decimal (float/double) to 2 decimal digits.
+    Pre-aggregated buckets of a source table, reports read these instead of scanning the source.
+
+    Concrete rollups name their source and aggregates and declare a unique constraint on the bucket and
+    the dimensions (checked by `manage.py check`), `refresh_rollups` keeps them up to date:
+
+        class MonthlyLogins(RollupModel):
+            school = models.ForeignKey(School, on_delete=models.CASCADE)
+            logins = models.PositiveIntegerField(default=0)
+
+            rollup_source = 'accounts.Login'
+            rollup_date_field = 'created_at'
+            rollup_dimensions = ('school',)
+
+            @classmethod
+            def rollup_aggregates(cls):
+                return {'logins': Count('pk')}
+
+            class Meta:
+                constraints = [models.UniqueConstraint(fields=['bucket', 'school'], name='monthly_logins_uniq')]
+
+    Incremental refreshes recompute the buckets of the source rows whose `rollup_watermark_field` moved past
+    the last refresh. They can't see the buckets a row left: sources must soft delete their rows (bumping the
+    watermark field) and never change their `rollup_date_field`, otherwise refresh the buckets involved with
+    `refresh(start, end)`.
     """
+    bucket = models.DateField(db_index=True)
+
+    rollup_source = None
+    rollup_date_field = 'created_at'
+    rollup_watermark_field = 'updated_at'
+    rollup_kind = 'month'
+    rollup_dimensions = ()
+
+    objects = RollupManager()
+
+    @classmethod
+    def rollup_aggregates(cls) -> dict:
+        raise NotImplementedError('subclasses of RollupModel must provide a rollup_aggregates() method')
+
+    @classmethod
+    def get_source_model(cls):
+        return apps.get_model(cls.rollup_source) if isinstance(cls.rollup_source, str) else cls.rollup_source
+
+    @classmethod
+    def check(cls, **kwargs):
+        errors = super().check(**kwargs)
+        fields = {'bucket', *cls.rollup_dimensions}
+        unique = [set(constraint.fields) for constraint in cls._meta.constraints
+                  if isinstance(constraint, models.UniqueConstraint) and constraint.condition is None]
+        unique += [set(fields) for fields in cls._meta.unique_together]
+        if fields not in unique:
+            errors.append(checks.Error(
+                f"{cls._meta.label} has no unique constraint on {', '.join(sorted(fields))}.",
+                hint="Concurrent refreshes could write a bucket twice, add a UniqueConstraint on these fields.",
+                obj=cls,
+                id='authentication.E001',
+            ))
+        return errors
+
+    class Meta:
+        abstract = True
 
-    function = 'ROUND'
-    arity = 2
 
-    def __ror__(self, other):
-        pass
+class RollupState(models.Model):
+    """
+    Where the incremental refresh of a RollupModel resumes, kept apart from its rows so an empty rollup
+    isn't refreshed in full again. The row is locked for the refresh, refreshes of one rollup run one at a time.
+    """
+    rollup = models.CharField(max_length=100, unique=True)
+    # latest `rollup_watermark_field` of the source aggregated in the rollup.
+    watermark = models.DateTimeField(null=True, blank=True)
 
-    def __rand__(self, other):
-        pass
+    class Meta:
+        verbose_name = _("Rollup state")
+        verbose_name_plural = _("Rollup states")
 
 
-class Month(Func):
+class Round(functions.Round):
     """
-    aggregation function extracts the month number from the database date or timestamp field.
+    aggregation function rounds the decimal (float/double) to 2 decimal digits.
     """
 
-    function = 'EXTRACT'
-    template = '%(function)s(MONTH from %(expressions)s)'
-    output_field = models.IntegerField()
+    def __init__(self, expression, precision=2, **extra):
+        super().__init__(expression, precision=precision, **extra)
 
-    def __rand__(self, other):
-        pass
 
-    def __ror__(self, other):
-        pass
+class Month(functions.ExtractMonth):
+    """
+    aggregation function extracts the month number from the database date or timestamp field.
+
+    Grouping a large table by month wraps the column and scans it, use `authentication.reports.bucketed`
+    or a RollupModel for reports.
+    """
@@ -0,0 +1,161 @@
+"""
+Time bounded storage of password reset OTPs.
+
+OTPs are only stored as keyed digests (`Verification.otp`), they expire after `OTP_STORE['TTL']` seconds
+or `OTP_STORE['MAX_ATTEMPTS']` uses. A use is a lookup of the right OTP, a wrong OTP matches no verification
+and isn't counted anywhere: guessing is bounded by the `otp_ip` / `otp_identifier` rate limits.
+With `OTP_STORE['BACKEND'] = 'cache'` active OTPs are mirrored in django's cache and validating them costs
+no database read.
+"""
+from datetime import timedelta
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, Q
+from django.utils import timezone
+
+from authentication.utils import get_verification_model, hash_otp, generate_otps, OTP_LENGTH, OTP_ALPHABET
+
+DEFAULT_OTP_STORE = {
+    'BACKEND': 'database',
+    'CACHE_ALIAS': 'default',
+    'TTL': 900,
+    'MAX_ATTEMPTS': 5,
+}
+
+
+def get_otp_settings() -> dict:
+    return {**DEFAULT_OTP_STORE, **getattr(settings, 'OTP_STORE', {})}
+
+
+class OTPExpired(Exception):
+    pass
+
+
+class OTPRecord(NamedTuple):
+    pk: int
+    email: Optional[str]
+    phone: Optional[str]
+    digest: str
+
+
+class DatabaseOTPStore:
+
+    def __init__(self, ttl=900, max_attempts=5):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    @property
+    def model(self):
+        return get_verification_model()
+
+    def cutoff(self, now=None):
+        return (now or timezone.now()) - timedelta(seconds=self.ttl)
+
+    def issue(self, verification):
+        pass
+
+    def forget(self, digest: str):
+        pass
+
+    def get(self, otp: str) -> Optional[OTPRecord]:
+        """
+        Returns the active verification of the OTP and counts the use, None when unknown.
+
+        Raises OTPExpired for a used, timed out or exhausted OTP.
+        """
+        digest = hash_otp(otp)
+        row = self.model.objects.filter(otp=digest).values(
+            'pk', 'email', 'phone', 'expired', 'created_at', 'attempts'
+        ).first()
+        if row is None:
+            return None
+        if row['expired'] or row['created_at'] < self.cutoff() or row['attempts'] >= self.max_attempts:
+            raise OTPExpired()
+        self.model.objects.filter(pk=row['pk']).update(attempts=F('attempts') + 1)
+        return OTPRecord(row['pk'], row['email'], row['phone'], digest)
+
+    def is_valid(self, otp: str) -> bool:
+        """
+        Whether the OTP is active, without counting a use.
+        """
+        return self.model.objects.filter(
+            otp=hash_otp(otp), expired=False, created_at__gte=self.cutoff(), attempts__lt=self.max_attempts
+        ).exists()
+
+    def consume(self, record: OTPRecord):
+        self.model.objects.filter(pk=record.pk).update(expired=True)
+        self.forget(record.digest)
+
+    def stale(self, now=None):
+        return self.model.objects.filter(Q(expired=True) | Q(created_at__lt=self.cutoff(now)))
+
+
+class CacheOTPStore(DatabaseOTPStore):
+
+    def __init__(self, cache_alias='default', **kwargs):
+        super().__init__(**kwargs)
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def make_key(digest: str) -> str:
+        return f'otp:{digest}'
+
+    def issue(self, verification):
+        key = self.make_key(verification.otp)
+        record = OTPRecord(verification.pk, verification.email, verification.phone, verification.otp)
+        self.cache.set_many({key: tuple(record), f'{key}:attempts': 0}, self.ttl)
+
+    def forget(self, digest: str):
+        self.cache.delete_many([self.make_key(digest), f'{self.make_key(digest)}:attempts'])
+
+    def get(self, otp: str) -> Optional[OTPRecord]:
+        key = self.make_key(hash_otp(otp))
+        record = self.cache.get(key)
+        if record is None:
+            return None
+        try:
+            attempts = self.cache.incr(f'{key}:attempts')
+        except ValueError:
+            # the attempts counter was evicted, the record can't be trusted anymore.
+            raise OTPExpired()
+        if attempts > self.max_attempts:
+            raise OTPExpired()
+        return OTPRecord(*record)
+
+    def is_valid(self, otp: str) -> bool:
+        key = self.make_key(hash_otp(otp))
+        values = self.cache.get_many([key, f'{key}:attempts'])
+        return key in values and values.get(f'{key}:attempts', self.max_attempts) < self.max_attempts
+
+
+def generate_unique_otps(count: int, length: int = OTP_LENGTH, alphabet: str = OTP_ALPHABET, model=None) -> list:
+    """
+    Returns `count` (otp, digest) pairs whose digests aren't stored yet in `model` (the verification model
+    by default), checked with one query per round.
+
+    Raises ValueError when `count` exceeds the number of distinct OTPs.
+    """
+    model = model or get_verification_model()
+    pairs = {}
+    while len(pairs) < count:
+        candidates = {}
+        for otp in generate_otps(count - len(pairs), length, alphabet):
+            digest = hash_otp(otp)
+            if digest not in pairs:
+                candidates[digest] = otp
+        taken = set(model._base_manager.filter(otp__in=list(candidates)).values_list('otp', flat=True))
+        pairs.update((digest, otp) for digest, otp in candidates.items() if digest not in taken)
+    return [(otp, digest) for digest, otp in pairs.items()]
+
+
+def get_otp_store() -> DatabaseOTPStore:
+    config = get_otp_settings()
+    if config['BACKEND'] == 'cache':
+        return CacheOTPStore(cache_alias=config['CACHE_ALIAS'], ttl=config['TTL'], max_attempts=config['MAX_ATTEMPTS'])
+    return DatabaseOTPStore(ttl=config['TTL'], max_attempts=config['MAX_ATTEMPTS'])
@@ -0,0 +1,158 @@
+"""
+Delivery of verification messages off the request path.
+
+`Verification.send` only queues OutboxMessage rows, `drain_outbox` (the `drain_outbox` management
+command or a periodic task) delivers them in batches: emails over one SMTP connection, SMS through a
+single gateway call, failures are retried with exponential backoff.
+"""
+import copy
+from collections import defaultdict
+from datetime import timedelta
+from itertools import zip_longest
+
+from django.apps import apps
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from authentication.mail import password_reset_renderer
+from authentication.sms import SMSMessage, get_sms_backend
+
+DEFAULT_OUTBOX = {
+    'BATCH_SIZE': 100,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF': 30,
+    'MAX_BACKOFF': 3600,
+}
+
+
+def get_outbox_settings() -> dict:
+    return {**DEFAULT_OUTBOX, **getattr(settings, 'VERIFICATION_OUTBOX', {})}
+
+
+def get_backoff(attempts: int) -> timedelta:
+    config = get_outbox_settings()
+    return timedelta(seconds=min(config['BACKOFF'] * 2 ** (attempts - 1), config['MAX_BACKOFF']))
+
+
+def with_otp(verification, message):
+    """
+    Copy of the verification carrying the plain OTP queued with the message.
+    """
+    verification = copy.copy(verification)
+    verification.raw_otp = message.otp
+    return verification
+
+
+def load_verifications(messages) -> dict:
+    """
+    Loads the verifications of the messages with one query per verification model.
+    """
+    ids = defaultdict(set)
+    for message in messages:
+        ids[message.verification_model].add(message.verification_id)
+    verifications = {}
+    for label, pks in ids.items():
+        for pk, verification in apps.get_model(label).objects.in_bulk(pks).items():
+            verifications[(label, pk)] = verification
+    return verifications
+
+
+def send_emails(messages, verifications) -> dict:
+    """
+    Renders the emails in one batch and sends them over a single connection,
+    returns the error of every failed message.
+    """
+    errors = {}
+    if not messages:
+        return errors
+    emails = password_reset_renderer.build_messages(
+        [with_otp(verifications[(message.verification_model, message.verification_id)], message)
+         for message in messages]
+    )
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        return {message.pk: exc for message in messages}
+    try:
+        for message, email in zip(messages, emails):
+            try:
+                connection.send_messages([email])
+            except Exception as exc:
+                errors[message.pk] = exc
+    finally:
+        connection.close()
+    return errors
+
+
+def send_sms(messages, verifications) -> dict:
+    errors = {}
+    if not messages:
+        return errors
+    batch = []
+    for message in messages:
+        verification = verifications[(message.verification_model, message.verification_id)]
+        batch.append(SMSMessage(message.recipient, with_otp(verification, message).build_sms()))
+    try:
+        accepted = get_sms_backend().send_messages(batch)
+    except Exception as exc:
+        accepted = [exc] * len(batch)
+    # a message the gateway returned no result for wasn't delivered as far as we know.
+    for message, result in zip_longest(messages, accepted[:len(messages)]):
+        if result is None:
+            errors[message.pk] = 'no result from the SMS gateway'
+        elif result is not True:
+            errors[message.pk] = result if isinstance(result, Exception) else 'rejected by the SMS gateway'
+    return errors
+
+
+def drain_outbox(batch_size: int = None) -> int:
+    """
+    Delivers one batch of due messages, returns the number of messages handled.
+
+    The batch is claimed in a short transaction, its attempt counted and its next attempt pushed back,
+    so other workers skip it while it is sent outside of any transaction. A worker dying mid delivery
+    leaves the messages to be retried once their backoff is over.
+    """
+    from authentication.models import OutboxMessage
+
+    config = get_outbox_settings()
+    batch_size = batch_size or config['BATCH_SIZE']
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(OutboxMessage.objects.due(now).select_for_update(skip_locked=True)[:batch_size])
+        if not messages:
+            return 0
+        for message in messages:
+            message.attempts += 1
+            message.next_attempt_at = now + get_backoff(message.attempts)
+        OutboxMessage.objects.bulk_update(messages, ['attempts', 'next_attempt_at'])
+
+    verifications = load_verifications(messages)
+    deliverable = []
+    for message in messages:
+        verification = verifications.get((message.verification_model, message.verification_id))
+        if verification is None or verification.expired:
+            # deleted or used meanwhile, nothing left to deliver.
+            message.given_up = True
+            message.last_error = 'verification deleted or expired'
+        else:
+            deliverable.append(message)
+    errors = send_emails([m for m in deliverable if m.channel == OutboxMessage.EMAIL], verifications)
+    errors.update(send_sms([m for m in deliverable if m.channel == OutboxMessage.SMS], verifications))
+
+    now = timezone.now()
+    for message in deliverable:
+        if message.pk in errors:
+            message.last_error = str(errors[message.pk])
+            message.given_up = message.attempts >= config['MAX_ATTEMPTS']
+        else:
+            message.sent_at = now
+            message.last_error = ''
+    for message in messages:
+        if message.sent_at or message.given_up:
+            message.otp = ''
+    OutboxMessage.objects.bulk_update(messages, ['last_error', 'given_up', 'sent_at', 'otp'])
+    return len(messages)
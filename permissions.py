@@ -1,47 +1,163 @@
 from typing import Iterable
 
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from rest_framework.response import Response
+
+
+def get_cost(perm) -> int:
+    """
+    Relative cost hint of a permission check, in-memory checks should declare `cost = 0`,
+    checks hitting the database a higher one. Cheaper checks run first in Or / And.
+    """
+    return getattr(perm, 'cost', 1)
+
+
+def get_cache_key(perm):
+    """
+    Results are cached per permission instance, instances defining the same `cache_key` share them,
+    e.g. a permission without parameters sharing its results across composites with `cache_key = 'is_staff'`.
+    """
+    return getattr(perm, 'cache_key', None) or id(perm)
+
+
+def _request_results(request) -> dict:
+    results = getattr(request, '_permission_results', None)
+    if results is None:
+        results = {}
+        request._permission_results = results
+    return results
+
+
+def check_permission(perm, request, view) -> bool:
+    """
+    `perm.has_permission`, evaluated once per request.
+    """
+    results = _request_results(request)
+    key = (get_cache_key(perm), id(view))
+    if key not in results:
+        # the permission is kept with its result so its id isn't reused during the request.
+        results[key] = (perm, bool(perm.has_permission(request, view)))
+    return results[key][1]
+
+
+def check_objects_permission(perm, request, view, objs) -> list:
+    """
+    `perm.has_object_permission` for every object, in one batch when the permission supports it.
+    """
+    if hasattr(perm, 'has_objects_permission'):
+        return list(perm.has_objects_permission(request, view, objs))
+    return [bool(perm.has_object_permission(request, view, obj)) for obj in objs]
 
 
 class IsReadOnly(BasePermission):
     """
     The request is a read-only request.
     """
+    cost = 0
 
     def has_permission(self, request, view):
         return bool(request.method in SAFE_METHODS)
 
 
 class IsStaff(BasePermission):
+    cost = 0
 
     def has_permission(self, request, view):
         return request.user.is_authenticated and request.user.is_staff
 
 
-class Or(BasePermission):
+class CompositePermission(BasePermission):
+    """
+    Combines permissions (classes or instances), children run cheapest first and their results
+    are cached for the request, so a child shared by nested composites is evaluated once.
+    """
 
     def __init__(self, perms: Iterable['BasePermission']):
-        self.perms = perms
+        perms = [perm() if isinstance(perm, type) else perm for perm in perms]
+        self.perms = sorted(perms, key=get_cost)
         super().__init__()
 
+    @property
+    def cost(self):
+        return sum(get_cost(perm) for perm in self.perms)
+
+    @property
+    def cache_key(self):
+        return type(self), tuple(get_cache_key(perm) for perm in self.perms)
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+
+class Or(CompositePermission):
+
     def has_permission(self, request, view):
         for perm in self.perms:
-            if perm.has_permission(request, view):
+            if check_permission(perm, request, view):
                 return True
         return False
 
-    def __call__(self, *args, **kwargs):
-        return self
+    def has_object_permission(self, request, view, obj):
+        return self.has_objects_permission(request, view, [obj])[0]
 
+    def has_objects_permission(self, request, view, objs):
+        """
+        An object is allowed by the first child granting both the permission and the object permission.
+        """
+        allowed = [False] * len(objs)
+        for perm in self.perms:
+            pending = [i for i, ok in enumerate(allowed) if not ok]
+            if not pending:
+                break
+            if not check_permission(perm, request, view):
+                continue
+            results = check_objects_permission(perm, request, view, [objs[i] for i in pending])
+            for i, ok in zip(pending, results):
+                allowed[i] = ok
+        return allowed
 
-class And(BasePermission):
-    def __init__(self, perms: Iterable['BasePermission']):
-        self.perms = perms
+
+class And(CompositePermission):
 
     def has_permission(self, request, view):
         for perm in self.perms:
-            if not perm.has_permission(request, view):
+            if not check_permission(perm, request, view):
                 return False
         return True
 
+    def has_object_permission(self, request, view, obj):
+        return self.has_objects_permission(request, view, [obj])[0]
+
+    def has_objects_permission(self, request, view, objs):
+        allowed = [True] * len(objs)
+        for perm in self.perms:
+            pending = [i for i, ok in enumerate(allowed) if ok]
+            if not pending:
+                break
+            results = check_objects_permission(perm, request, view, [objs[i] for i in pending])
+            for i, ok in zip(pending, results):
+                allowed[i] = ok
+        return allowed
+
+
+class BatchObjectPermissionMixin:
+    """
+    List view mixin keeping only the objects of the page the user has object permission on,
+    checked with `has_objects_permission` so a permission can answer for the whole page in one query.
+    """
 
+    def check_objects_permissions(self, request, objs):
+        allowed = [True] * len(objs)
+        for permission in self.get_permissions():
+            results = check_objects_permission(permission, request, self, objs)
+            allowed = [a and r for a, r in zip(allowed, results)]
+        return [obj for obj, ok in zip(objs, allowed) if ok]
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objs = self.check_objects_permissions(request, list(page if page is not None else queryset))
+        serializer = self.get_serializer(objs, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
@@ -0,0 +1,167 @@
+"""
+Reporting toolkit: date bucketing that filters by range before grouping, so the date index is range scanned,
+and incremental refresh of RollupModel tables.
+"""
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Max, Min
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek, TruncYear
+from django.utils import timezone
+
+TRUNCATE = {
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+    'year': TruncYear,
+}
+
+
+def truncate(expression, kind: str):
+    """
+    `expression` truncated to the first day of its day / week / month / year, as a date.
+    Backed by django's Trunc, `date_trunc` on PostgreSQL and `strftime` based functions on SQLite.
+    """
+    try:
+        trunc = TRUNCATE[kind]
+    except KeyError:
+        raise ValueError(f"Unknown bucket kind {kind!r}, expected one of {', '.join(TRUNCATE)}.")
+    return trunc(expression, output_field=models.DateField())
+
+
+def bucket_start(value, kind: str) -> date:
+    if isinstance(value, datetime):
+        value = timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    if kind == 'day':
+        return value
+    if kind == 'week':
+        return value - timedelta(days=value.weekday())
+    if kind == 'month':
+        return value.replace(day=1)
+    if kind == 'year':
+        return value.replace(month=1, day=1)
+    raise ValueError(f"Unknown bucket kind {kind!r}, expected one of {', '.join(TRUNCATE)}.")
+
+
+def next_bucket(start: date, kind: str) -> date:
+    if kind == 'day':
+        return start + timedelta(days=1)
+    if kind == 'week':
+        return start + timedelta(days=7)
+    if kind == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start.replace(year=start.year + 1)
+
+
+def bucket_ranges(start, end, kind: str):
+    """
+    [lower, upper) date ranges of the buckets covering `start` up to `end` excluded.
+    """
+    lower = bucket_start(start, kind)
+    end = end.date() if isinstance(end, datetime) else end
+    while lower < end:
+        upper = next_bucket(lower, kind)
+        yield lower, upper
+        lower = upper
+
+
+def _bound(model, field: str, value):
+    if isinstance(model._meta.get_field(field), models.DateTimeField) and not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+        return timezone.make_aware(value) if settings.USE_TZ else value
+    return value
+
+
+def bucketed(queryset, field: str, kind: str, start=None, end=None, dimensions=(), **aggregates):
+    """
+    `aggregates` of `queryset` per `kind` bucket of `field` (and per `dimensions`), as `values()` rows with
+    a `bucket` date. Rows are restricted to [start, end) on the bare column first, an index range scan.
+    """
+    model = queryset.model
+    if start is not None:
+        queryset = queryset.filter(**{f'{field}__gte': _bound(model, field, bucket_start(start, kind))})
+    if end is not None:
+        queryset = queryset.filter(**{f'{field}__lt': _bound(model, field, end)})
+    return queryset.annotate(bucket=truncate(field, kind)).order_by() \
+        .values('bucket', *dimensions).annotate(**aggregates).order_by('bucket', *dimensions)
+
+
+def lock_rollup_state(rollup):
+    """
+    RollupState of `rollup`, locked until the end of the running transaction.
+    """
+    from authentication.models import RollupState
+
+    return RollupState.objects.using(rollup.objects.db).select_for_update() \
+        .get_or_create(rollup=rollup._meta.label)[0]
+
+
+def get_watermark(rollup):
+    if not rollup.rollup_watermark_field:
+        return None
+    source = rollup.get_source_model()
+    return source._base_manager.aggregate(last=Max(rollup.rollup_watermark_field))['last']
+
+
+def recompute_buckets(rollup, start=None, end=None) -> int:
+    source = rollup.get_source_model()
+    if start is not None:
+        start = bucket_start(start, rollup.rollup_kind)
+    if end is not None:
+        end = next_bucket(bucket_start(end, rollup.rollup_kind), rollup.rollup_kind)
+    rows = bucketed(source._default_manager.all(), rollup.rollup_date_field, rollup.rollup_kind, start, end,
+                    dimensions=rollup.rollup_dimensions, **rollup.rollup_aggregates())
+    attnames = {name: rollup._meta.get_field(name).attname for name in rollup.rollup_dimensions}
+    instances = [rollup(**{attnames.get(name, name): value for name, value in row.items()}) for row in rows]
+    stale = rollup._base_manager.all()
+    if start is not None:
+        stale = stale.filter(bucket__gte=start)
+    if end is not None:
+        stale = stale.filter(bucket__lt=end)
+    stale.delete()
+    rollup.objects.bulk_create(instances, batch_size=1000)
+    return len(instances)
+
+
+def refresh_rollup(rollup, start=None, end=None) -> int:
+    """
+    Recomputes the buckets of `rollup` from the one holding `start` to the one holding `end`,
+    all of them when no bounds are given, which also moves the incremental refresh's watermark.
+    Returns the number of rollup rows written.
+    """
+    with transaction.atomic(using=rollup.objects.db):
+        state = lock_rollup_state(rollup)
+        full = start is None and end is None
+        # read first, rows changing while the buckets are computed are picked up by the next refresh.
+        watermark = get_watermark(rollup) if full else None
+        written = recompute_buckets(rollup, start, end)
+        if full:
+            state.watermark = watermark
+            state.save(update_fields=['watermark'])
+    return written
+
+
+def refresh_rollup_incremental(rollup) -> int:
+    """
+    Recomputes only the buckets holding source rows changed since the last refresh, soft deleted rows
+    included. Falls back to a full refresh when the rollup was never refreshed in full.
+    """
+    if not rollup.rollup_watermark_field:
+        return refresh_rollup(rollup)
+    with transaction.atomic(using=rollup.objects.db):
+        state = lock_rollup_state(rollup)
+        if state.watermark is None:
+            return refresh_rollup(rollup)
+        watermark = get_watermark(rollup)
+        source = rollup.get_source_model()
+        changed = source._base_manager.filter(**{
+            f'{rollup.rollup_watermark_field}__gt': state.watermark,
+            f'{rollup.rollup_watermark_field}__lte': watermark,
+        }).aggregate(lower=Min(rollup.rollup_date_field), upper=Max(rollup.rollup_date_field))
+        if changed['lower'] is None:
+            return 0
+        written = recompute_buckets(rollup, changed['lower'], changed['upper'])
+        state.watermark = watermark
+        state.save(update_fields=['watermark'])
+    return written
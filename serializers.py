@@ -1,11 +1,14 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission, Group
-from django.db.models import Q
 from django.db.transaction import atomic
 from rest_framework.authtoken.serializers import AuthTokenSerializer
-from rest_framework.serializers import ModelSerializer, Serializer, EmailField, CharField, ValidationError
+from rest_framework.serializers import ModelSerializer, Serializer, EmailField, CharField, ValidationError, \
+    ListField, IntegerField, BooleanField, DateTimeField
 from django.utils.translation import gettext as _
 
+from authentication.hashers import set_password
+from authentication.models import AccessCode
+from authentication.otp import OTPExpired, get_otp_store
 from authentication.utils import get_verification_model
 from authentication.validators import PhoneValidator
 
@@ -35,13 +38,12 @@ class AdvancedAuthTokenSerializer(AuthTokenSerializer):
         access_code = attrs.get('access_code')
 
         if access_code:
-            try:
-                user = User.objects.get(access_code=access_code)
-                attrs['user'] = user
-                return attrs
-            except User.DoesNotExist:
+            user = AccessCode.objects.resolve_user(access_code)
+            if user is None:
                 msg = _('Unable to log in with provided credentials.')
                 raise ValidationError(msg, code='authorization')
+            attrs['user'] = user
+            return attrs
         else:
             return super().validate(attrs)
 
@@ -83,21 +85,15 @@ class RequestPasswordResetSerializer(Serializer):
 
     def create(self, validated_data):
         if validated_data.get('email'):
-            if not User.objects.filter(email=validated_data.get('email')).exists():
-                raise ValidationError(_("User doesn't exist."))
-
-            if Verification.objects.filter(Q(email=validated_data.get('email')), expired=False).exists():
-                instance = Verification.objects.filter(Q(email=validated_data.get('email'))).first()
-            else:
-                instance = Verification.objects.create(email=validated_data.get('email'))
+            lookup = {'email': validated_data.get('email')}
         else:
-            if not User.objects.filter(phone=validated_data.get('phone')).exists():
-                raise ValidationError(_("User doesn't exist."))
+            lookup = {'phone': validated_data.get('phone')}
+
+        if not User.objects.filter(**lookup).exists():
+            raise ValidationError(_("User doesn't exist."))
 
-            if Verification.objects.filter(Q(phone=validated_data.get('phone')), expired=False).exists():
-                instance = Verification.objects.filter(Q(phone=validated_data.get('phone'))).first()
-            else:
-                instance = Verification.objects.create(phone=validated_data.get('phone'))
+        # the partial unique constraints on active verifications make this safe under concurrent requests.
+        instance, created = Verification.objects.get_or_create(**lookup, expired=False)
         instance.send()
         return instance
 
@@ -113,12 +109,12 @@ class PasswordResetSerializer(Serializer):
             raise ValidationError(msg, code="unmatch")
 
         try:
-            verification = Verification.objects.get(otp=attrs.get('otp'))
-            if verification.expired:
-                raise ValidationError(_('Password reset expired'))
-            self.verification = verification
-        except Verification.DoesNotExist:
+            verification = get_otp_store().get(attrs.get('otp'))
+        except OTPExpired:
+            raise ValidationError(_('Password reset expired'))
+        if verification is None:
             raise ValidationError(_('Password Reset Request not found'))
+        self.verification = verification
 
         return attrs
 
@@ -131,9 +127,29 @@ class PasswordResetSerializer(Serializer):
             user = User.objects.get(email=self.verification.email)
         else:
             user = User.objects.get(phone=self.verification.phone)
-        user.set_password(validated_data.get('password'))
+        set_password(user, validated_data.get('password'))
         user.save()
-        self.verification.expired = True
-        self.verification.save()
+        get_otp_store().consume(self.verification)
         return user
 
+
+
+class RevokeTokensSerializer(Serializer):
+    device_name = CharField(required=False)
+    keep_current = BooleanField(default=False)
+
+
+class BulkIssueTokensSerializer(Serializer):
+    users = ListField(child=IntegerField(), allow_empty=False)
+    device_name = CharField(required=False, default='', allow_blank=True)
+
+
+class BulkRevokeTokensSerializer(Serializer):
+    users = ListField(child=IntegerField(), required=False, allow_empty=False)
+    device_name = CharField(required=False)
+    older_than = DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise ValidationError(_('You should provide at least one of users, device_name or older_than.'))
+        return super().validate(attrs)
@@ -0,0 +1,129 @@
+import atexit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.core.signals import request_finished, setting_changed
+from django.db import DatabaseError
+from django.db.models.signals import post_delete, post_save, m2m_changed
+from django.dispatch import receiver
+
+from authentication.caches import get_token_cache, reset_token_cache, invalidate_user_group_names, \
+    invalidate_user_permissions, bump_permissions_generation
+from authentication.executors import reset_hashing_pool
+from authentication.expiry import last_used_recorder
+from authentication.managers import ACCESS_CODE_MISS_KEY
+from authentication.models import MultiToken, AccessCode
+from authentication.throttling import reset_rate_limiter
+from authentication.utils import access_code_digest
+from authentication.writers import last_login_writer
+
+
+@receiver(post_delete, sender=MultiToken)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        token_cache.delete(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_inactive_user_tokens(sender, instance, created=False, **kwargs):
+    if created or instance.is_active:
+        return
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        token_cache.delete_many(MultiToken.objects.filter(user=instance).values_list('key', flat=True))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def sync_access_code_digest(sender, instance, update_fields=None, **kwargs):
+    if not hasattr(instance, 'access_code'):
+        return
+    if update_fields is not None and 'access_code' not in update_fields:
+        return
+    if instance.access_code:
+        AccessCode.objects.update_or_create(user=instance, defaults={'digest': access_code_digest(instance.access_code)})
+    else:
+        AccessCode.objects.filter(user=instance).delete()
+
+
+@receiver(post_save, sender=AccessCode)
+def forget_access_code_miss(sender, instance, **kwargs):
+    cache.delete(ACCESS_CODE_MISS_KEY.format(instance.digest))
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def invalidate_changed_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_user_caches([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_user_caches(pk_set)
+    elif action == 'pre_clear':
+        invalidate_group_members(instance)
+
+
+@receiver(m2m_changed, sender=get_user_model().user_permissions.through)
+def invalidate_changed_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_user_permissions([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_user_permissions(pk_set)
+    elif action == 'pre_clear':
+        invalidate_user_permissions(
+            get_user_model()._default_manager.filter(user_permissions=instance).values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_changed_group_permissions(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_permissions_generation()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def invalidate_changed_group_or_permission(sender, instance, **kwargs):
+    # new groups and permissions show up in the catalog views, new permissions are granted to superusers.
+    bump_permissions_generation()
+
+
+def invalidate_user_caches(user_ids):
+    user_ids = list(user_ids)
+    invalidate_user_group_names(user_ids)
+    invalidate_user_permissions(user_ids)
+
+
+def invalidate_group_members(group):
+    invalidate_user_caches(get_user_model()._default_manager.filter(groups=group).values_list('pk', flat=True))
+
+
+@receiver(request_finished)
+def flush_due_timestamps(**kwargs):
+    """
+    Writes the deferred timestamps back once due even when no later login or authentication comes to flush them.
+    """
+    last_login_writer.maybe_flush()
+    last_used_recorder.maybe_flush()
+
+
+@atexit.register
+def flush_pending_timestamps():
+    for writer in (last_login_writer, last_used_recorder):
+        try:
+            writer.flush()
+        except DatabaseError:
+            pass
+
+
+@receiver(setting_changed)
+def reset_caches(setting, **kwargs):
+    if setting == 'MULTI_TOKEN_CACHE':
+        reset_token_cache()
+    elif setting == 'PASSWORD_HASHING_POOL':
+        reset_hashing_pool()
+    elif setting == 'AUTH_RATE_LIMITS':
+        reset_rate_limiter()
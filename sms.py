@@ -0,0 +1,61 @@
+"""
+SMS gateway interface used by the verification outbox, configured with `settings.SMS_BACKEND`.
+"""
+import sys
+import threading
+from typing import NamedTuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class SMSMessage(NamedTuple):
+    recipient: str
+    body: str
+
+
+class BaseSMSBackend:
+
+    def send_messages(self, messages) -> list:
+        """
+        Sends a batch of SMSMessage, returns one boolean per message telling whether it was accepted.
+        """
+        raise NotImplementedError
+
+
+class ConsoleSMSBackend(BaseSMSBackend):
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def send_messages(self, messages) -> list:
+        with self._lock:
+            for message in messages:
+                self.stream.write(f"To: {message.recipient}\n{message.body}\n{'-' * 40}\n")
+            self.stream.flush()
+        return [True] * len(messages)
+
+
+class LocMemSMSBackend(BaseSMSBackend):
+    """
+    Keeps the messages in `authentication.sms.outbox`, for tests.
+    """
+
+    def send_messages(self, messages) -> list:
+        outbox.extend(messages)
+        return [True] * len(messages)
+
+
+class DummySMSBackend(BaseSMSBackend):
+
+    def send_messages(self, messages) -> list:
+        return [True] * len(messages)
+
+
+outbox = []
+
+
+def get_sms_backend(backend: str = None) -> BaseSMSBackend:
+    backend = backend or getattr(settings, 'SMS_BACKEND', 'authentication.sms.ConsoleSMSBackend')
+    return import_string(backend)()
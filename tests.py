@@ -1,10 +1,62 @@
+import asyncio
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipIf
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connection, models, transaction
+from django.db.models import Count, Q, QuerySet, Value
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.generics import ListAPIView
+from rest_framework.permissions import BasePermission
+from rest_framework.request import Request
+from rest_framework.serializers import ModelSerializer
+from rest_framework.test import APIRequestFactory, APITestCase
 
-from authentication.models import MultiToken
+from authentication import sms
+from authentication.authentication import MultiTokenAuthentication, WebsocketTokenResolver
+from authentication.backends import PhoneBackend
+from authentication.benchmarks import otp_entropy_report
+from authentication.caches import PERMISSIONS_GENERATION_KEY, get_token_cache, get_user_group_names
+from authentication.contexts import CurrentApplicationContext, CurrentTaskContext
+from authentication.expiry import last_used_recorder
+from authentication.executors import HashingPool, HashingPoolFull
+from authentication.hashers import get_dummy_hash, verify_password
+from authentication.history import bulk_update_with_history
+from authentication.mail import PasswordResetEmailRenderer
+from authentication.managers import CustomCategoryManager, prefetch_top_n, top_n_per_group
+from authentication.middleware import CurrentContextMiddleware, DRFTokenAuthMiddleware, DRFTokenSocketMiddleware
+from authentication.models import MultiToken, AccessCode, OutboxMessage, DeletableModel, visible_index, \
+    ChangeLog, DiffHistoryModel, SyncableModel, RollupModel, Month, Round
+from authentication.otp import OTPExpired, get_otp_store, generate_unique_otps
+from authentication.outbox import drain_outbox
+from authentication.permissions import And, IsReadOnly, IsStaff, Or
+from authentication.reports import bucket_start, bucketed
+from authentication.serializers import RequestPasswordResetSerializer
+from authentication.sync import ChangedSinceMixin
+from authentication.throttling import LocalRateLimitBackend, RateLimiter, get_rate_limiter
+from authentication.utils import access_code_digest, get_verification_model, hash_otp, generate_otps
+from authentication.validators import normalize_phone, phone_variants
+from authentication.views import LoginAPIView
+from authentication.writers import last_login_writer
 
 User = get_user_model()
+Verification = get_verification_model()
 
 
 class AuthenticationTests(APITestCase):
@@ -80,3 +132,1129 @@ class LogoutTests(APITestCase):
 #         response = self.client.post(self.reset_password_url, data, format='json')
 #         self.assertEqual(response.status_code, 200)
 #         self.assertEqual(response.data['details'], 'Password reset successfully')
+
+
+class TokenCacheTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.token = MultiToken.objects.create(user=self.user)
+        self.token_cache = get_token_cache()
+        self.token_cache.clear()
+        cache.clear()
+
+    def test_cached_token_skips_database(self):
+        MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user, token = MultiTokenAuthentication().authenticate_credentials(self.token.key)
+            self.assertTrue(user.is_authenticated)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(token.key, self.token.key)
+        self.assertGreaterEqual(self.token_cache.stats()['local_hits'], 1)
+
+    def test_logout_invalidates_cached_token(self):
+        MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.client.post(reverse('logout'))
+        self.assertIsNone(self.token_cache.get(self.token.key))
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            MultiTokenAuthentication().authenticate_credentials(self.token.key)
+
+    def test_deactivated_user_invalidates_cached_token(self):
+        MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            MultiTokenAuthentication().authenticate_credentials(self.token.key)
+
+
+class WebsocketTokenResolverTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.token = MultiToken.objects.create(user=self.user)
+        get_token_cache().clear()
+        cache.clear()
+
+    async def test_concurrent_lookups_share_one_query(self):
+        resolver = WebsocketTokenResolver()
+        lookup = resolver.authentication.authenticate_credentials
+        with mock.patch.object(resolver.authentication, 'authenticate_credentials', wraps=lookup) as mocked:
+            results = await asyncio.gather(*[resolver.resolve(self.token.key) for _ in range(10)])
+        self.assertEqual(mocked.call_count, 1)
+        self.assertTrue(all(user.pk == self.user.pk for user, token in results))
+
+    async def test_async_consumer_reads_scope_user(self):
+        seen = []
+
+        async def consumer(scope, receive, send):
+            seen.append((scope['user'].is_authenticated, scope['user'].pk, (await scope['auser']()).username))
+
+        scope = {'type': 'websocket', 'query_string': f'Authorization=Token {self.token.key}'.encode()}
+        for _ in range(2):
+            # the second connection is served from the token cache.
+            await DRFTokenSocketMiddleware(consumer)(scope, None, None)
+        self.assertEqual(seen, [(True, self.user.pk, 'testuser')] * 2)
+
+    async def test_warm_connections_load_the_user_once(self):
+        scope = {'type': 'websocket', 'query_string': f'Authorization=Token {self.token.key}'.encode()}
+        await DRFTokenSocketMiddleware(lambda scope, receive, send: asyncio.sleep(0))(scope, None, None)
+        users = []
+
+        async def consumer(scope, receive, send):
+            users.append(scope['user'].pk)
+
+        async def loading_consumer(scope, receive, send):
+            users.append((await scope['auser']()).username)
+
+        aget = QuerySet.aget
+        with mock.patch.object(QuerySet, 'aget', autospec=True, side_effect=aget) as lookups:
+            await asyncio.gather(*[DRFTokenSocketMiddleware(consumer)(scope, None, None) for _ in range(20)])
+            self.assertEqual(lookups.call_count, 0)
+            await asyncio.gather(*[DRFTokenSocketMiddleware(loading_consumer)(scope, None, None) for _ in range(20)])
+            self.assertEqual(lookups.call_count, 1)
+        self.assertEqual(users, [self.user.pk] * 20 + ['testuser'] * 20)
+
+    async def test_anonymous_connection(self):
+        seen = []
+
+        async def consumer(scope, receive, send):
+            seen.append(scope['user'].is_authenticated)
+
+        await DRFTokenSocketMiddleware(consumer)({'type': 'websocket', 'query_string': b''}, None, None)
+        self.assertEqual(seen, [False])
+
+
+@override_settings(MULTI_TOKEN_CACHE={'ENABLED': False})
+class LazyTokenMiddlewareTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.token = MultiToken.objects.create(user=self.user)
+        self.request = RequestFactory().get('/', HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.request.user = AnonymousUser()
+
+    def test_untouched_user_costs_no_query(self):
+        with self.assertNumQueries(0):
+            DRFTokenAuthMiddleware(lambda request: None).process_request(self.request)
+
+    def test_token_is_looked_up_once(self):
+        DRFTokenAuthMiddleware(lambda request: None).process_request(self.request)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.request.user.pk, self.user.pk)
+            user, token = MultiTokenAuthentication().authenticate(Request(self.request))
+        self.assertEqual(token.key, self.token.key)
+
+
+class BulkTokenTests(APITestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='testpassword') for i in range(5)]
+        self.admin = User.objects.create_superuser(username='admin', password='testpassword')
+        self.client.force_authenticate(self.admin)
+
+    def test_issue_uses_one_insert(self):
+        with self.assertNumQueries(1):
+            tokens = MultiToken.objects.issue(self.users, device_name='kiosk')
+        self.assertEqual(len({token.key for token in tokens}), 5)
+
+    def test_revoke_for_users_is_set_based(self):
+        MultiToken.objects.issue(self.users * 3)
+        # the keys, then the chunk's DELETE.
+        with self.assertNumQueries(2):
+            revoked = MultiToken.objects.for_users(self.users[:3]).revoke()
+        self.assertEqual(revoked, 9)
+        self.assertEqual(MultiToken.objects.count(), 6)
+
+    def test_revoke_invalidates_the_cache_per_chunk(self):
+        MultiToken.objects.issue(self.users * 120)
+        token_cache = get_token_cache()
+        with mock.patch.object(token_cache, 'delete', wraps=token_cache.delete) as delete, \
+                mock.patch.object(token_cache, 'delete_many', wraps=token_cache.delete_many) as delete_many:
+            self.assertEqual(MultiToken.objects.all().revoke(), 600)
+        self.assertEqual(delete.call_count, 0)
+        self.assertEqual(delete_many.call_count, 2)
+
+    def test_for_users_accepts_a_user_queryset(self):
+        MultiToken.objects.issue(self.users)
+        tokens = MultiToken.objects.for_users(User.objects.filter(username__in=['user0', 'user1']))
+        self.assertEqual(tokens.count(), 2)
+
+    def test_revoked_token_leaves_the_cache(self):
+        token = MultiToken.objects.create(user=self.users[0])
+        MultiTokenAuthentication().authenticate_credentials(token.key)
+        MultiToken.objects.for_users([self.users[0]]).revoke()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            MultiTokenAuthentication().authenticate_credentials(token.key)
+
+    def test_bulk_revoke_endpoint(self):
+        MultiToken.objects.issue(self.users, device_name='kiosk')
+        MultiToken.objects.issue(self.users, device_name='phone')
+        response = self.client.post(reverse('bulk_revoke_tokens'), {'device_name': 'kiosk'}, format='json')
+        self.assertEqual(response.data['revoked'], 5)
+        self.assertFalse(MultiToken.objects.for_device('kiosk').exists())
+
+
+@override_settings(MULTI_TOKEN_EXPIRY={'TTL': 3600, 'IDLE_TTL': 600})
+class TokenExpiryTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.token = MultiToken.objects.create(user=self.user)
+        get_token_cache().clear()
+        last_used_recorder.reset()
+
+    def test_absolute_ttl_rejects_old_token(self):
+        MultiToken.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(hours=2),
+                                                             last_used=timezone.now())
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        self.assertFalse(MultiToken.objects.filter(pk=self.token.pk).exists())
+
+    def test_last_used_is_written_back_in_batches(self):
+        with self.assertNumQueries(1):
+            MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        self.assertEqual(last_used_recorder.flush(), 1)
+        self.token.refresh_from_db()
+        self.assertIsNotNone(self.token.last_used)
+
+    @override_settings(MULTI_TOKEN_EXPIRY={})
+    def test_nothing_is_recorded_without_expiry(self):
+        MultiTokenAuthentication().authenticate_credentials(self.token.key)
+        self.assertIsNone(last_used_recorder.last_seen(self.token.key))
+
+    def test_flush_is_chunked(self):
+        tokens = MultiToken.objects.issue([self.user] * 1200)
+        for token in tokens:
+            last_used_recorder.touch(token.key)
+        with self.assertNumQueries(3):
+            self.assertEqual(last_used_recorder.flush(), 1200)
+
+    def test_purge_expired_tokens(self):
+        fresh = MultiToken.objects.create(user=self.user)
+        MultiToken.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(hours=1))
+        call_command('purge_expired_tokens', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(MultiToken.objects.values_list('pk', flat=True)), [fresh.pk])
+
+
+@override_settings(DEFERRED_LAST_LOGIN={'ENABLED': True})
+class LoginQueryCountTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.user.groups.add(Group.objects.create(name='teachers'))
+        self.data = {'username': 'testuser', 'password': 'testpassword'}
+        cache.clear()
+
+    def test_login_query_count(self):
+        self.client.post(reverse('login'), self.data, format='json')
+        # user lookup and token insert, groups come from the cache and last_login is written later.
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse('login'), self.data, format='json')
+        self.assertEqual(response.data['groups'], ['teachers'])
+
+    def test_deferred_last_login_is_flushed_at_request_end(self):
+        last_login_writer.reset()
+        LoginAPIView().update_last_login(self.user)
+        self.assertIsNotNone(self.user.last_login)
+        self.assertIsNone(User.objects.get(pk=self.user.pk).last_login)
+        last_login_writer._pending_since -= 3600
+        request_finished.send(sender=None)
+        self.assertIsNotNone(User.objects.get(pk=self.user.pk).last_login)
+
+    def test_group_change_invalidates_cached_names(self):
+        self.assertEqual(get_user_group_names(self.user), ['teachers'])
+        self.user.groups.clear()
+        self.assertEqual(get_user_group_names(self.user), [])
+
+
+@override_settings(
+    PASSWORD_HASHERS=['authentication.hashers.ProfiledPBKDF2PasswordHasher'],
+    PASSWORD_HASHER_PROFILES={'fast': {'pbkdf2_iterations': 1000}, 'strong': {'pbkdf2_iterations': 2000}},
+    PASSWORD_HASHER_PROFILE='fast',
+)
+class HasherProfileTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+
+    def test_profile_sets_hash_cost(self):
+        self.assertEqual(self.user.password.split('$')[1], '1000')
+
+    def test_outdated_hash_is_upgraded_on_login(self):
+        with self.settings(PASSWORD_HASHER_PROFILE='strong'):
+            self.assertTrue(self.user.check_password('testpassword'))
+            self.user.refresh_from_db()
+        self.assertEqual(self.user.password.split('$')[1], '2000')
+
+    def test_hash_is_redone_when_the_preferred_hasher_changes(self):
+        with self.settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher',
+                                             'authentication.hashers.ProfiledPBKDF2PasswordHasher']):
+            self.assertTrue(verify_password(self.user, 'testpassword'))
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('md5$'))
+
+    def test_dummy_hash_is_precomputed(self):
+        self.assertIs(get_dummy_hash(), get_dummy_hash())
+        self.assertEqual(get_dummy_hash().split('$')[1], '1000')
+
+
+class HashingPoolTests(APITestCase):
+
+    def test_full_pool_rejects_fast(self):
+        pool = HashingPool(max_workers=1, max_queue=0)
+        release = threading.Event()
+        busy = pool.submit(release.wait)
+        with self.assertRaises(HashingPoolFull):
+            pool.submit(release.wait)
+        release.set()
+        busy.result()
+        self.assertTrue(pool.run(bool, 1))
+        self.assertEqual(pool.rejected, 1)
+        pool.shutdown()
+
+    @override_settings(PASSWORD_HASHING_POOL={'ENABLED': True, 'MAX_WORKERS': 2})
+    def test_verify_password_through_pool(self):
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        self.assertTrue(verify_password(user, 'testpassword'))
+        self.assertFalse(verify_password(user, 'wrong'))
+
+
+class PhoneBackendLookupTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword', phone='0555123456',
+                                             email='test@example.com')
+        self.backend = PhoneBackend()
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone('00213 555 12 34 56'), '+213555123456')
+        self.assertEqual(phone_variants('+213555123456'), ['+213555123456', '00213555123456', '0555123456'])
+        self.assertIsNone(normalize_phone('test@example.com'))
+
+    def test_every_identifier_authenticates(self):
+        for username in ('+213555123456', '0555123456', 'TEST@example.com', 'testuser'):
+            self.assertEqual(self.backend.authenticate(None, username=username, password='testpassword'), self.user)
+
+    def test_lookups_use_an_index(self):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET enable_seqscan = off')
+            for username in ('0555123456', 'TEST@example.com', 'testuser'):
+                plan = self.backend.get_login_queryset(username).explain()
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotIn('SCAN ', plan)
+
+
+class AccessCodeLoginTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword', access_code='A1B2C3')
+        cache.clear()
+
+    def test_login_with_access_code(self):
+        response = self.client.post(reverse('login'), {'access_code': 'A1B2C3'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(AccessCode.objects.filter(digest=access_code_digest('A1B2C3')).exists())
+
+    def test_repeated_bad_code_skips_database(self):
+        self.assertIsNone(AccessCode.objects.resolve_user('WRONG'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(AccessCode.objects.resolve_user('WRONG'))
+
+    def test_new_code_clears_cached_miss(self):
+        self.assertIsNone(AccessCode.objects.resolve_user('NEWCODE'))
+        self.user.access_code = 'NEWCODE'
+        self.user.save()
+        self.assertEqual(AccessCode.objects.resolve_user('NEWCODE'), self.user)
+
+    def test_shared_code_saves_and_logs_nobody_in(self):
+        User.objects.create_user(username='otheruser', password='testpassword', access_code='A1B2C3')
+        self.assertIsNone(AccessCode.objects.resolve_user('A1B2C3'))
+
+    def test_code_stored_under_fallback_key_is_found_and_rewritten(self):
+        with self.settings(SECRET_KEY='new-secret-key', SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]):
+            self.assertEqual(AccessCode.objects.resolve_user('A1B2C3'), self.user)
+            self.assertTrue(AccessCode.objects.filter(user=self.user, digest=access_code_digest('A1B2C3')).exists())
+
+
+@override_settings(AUTH_RATE_LIMITS={'BACKEND': 'local', 'RATES': {'login_ip': None, 'login_identifier': '2/min'}})
+class LoginRateLimitTests(APITestCase):
+
+    def setUp(self):
+        User.objects.create_user(username='testuser', password='testpassword')
+
+    def test_identifier_is_limited_before_hashing(self):
+        data = {'username': 'TestUser', 'password': 'wrong'}
+        for _ in range(2):
+            self.assertEqual(self.client.post(reverse('login'), data, format='json').status_code, 400)
+        with mock.patch('authentication.hashers.check_password') as check_password, self.assertNumQueries(0):
+            response = self.client.post(reverse('login'), data, format='json')
+        self.assertEqual(response.status_code, 429)
+        check_password.assert_not_called()
+        self.assertEqual(get_rate_limiter().stats()['rejected'], {'login_identifier': 1})
+
+    def test_sliding_window_forgets_old_attempts(self):
+        clock = mock.Mock(return_value=0)
+        limiter = RateLimiter(LocalRateLimitBackend(), clock=clock)
+        self.assertTrue(limiter.hit('otp_ip', '1.2.3.4', 1, 60))
+        self.assertFalse(limiter.hit('otp_ip', '1.2.3.4', 1, 60))
+        clock.return_value = 125
+        self.assertTrue(limiter.hit('otp_ip', '1.2.3.4', 1, 60))
+
+    def test_local_backend_drops_stale_windows(self):
+        clock = mock.Mock(return_value=0)
+        backend = LocalRateLimitBackend()
+        limiter = RateLimiter(backend, clock=clock)
+        for i in range(100):
+            limiter.hit('login_ip', f'10.0.0.{i}', 10, 60)
+        self.assertEqual(len(backend._windows), 100)
+        clock.return_value = 120
+        limiter.hit('login_ip', '10.0.1.1', 10, 60)
+        self.assertEqual(len(backend._windows), 1)
+
+
+@skipIf(Verification is None, "settings.VERIFICATION_MODEL is not configured")
+class RequestPasswordResetTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+
+    def test_request_reuses_active_verification(self):
+        first = RequestPasswordResetSerializer().create({'email': 'test@example.com'})
+        # user lookup, get_or_create's read, the new OTP's uniqueness check and UPDATE, the outbox INSERT.
+        with self.assertNumQueries(5):
+            second = RequestPasswordResetSerializer().create({'email': 'test@example.com'})
+        self.assertEqual(first.pk, second.pk)
+
+    def test_expired_verification_is_not_reused(self):
+        expired = Verification.objects.create(email='test@example.com', expired=True)
+        instance = RequestPasswordResetSerializer().create({'email': 'test@example.com'})
+        self.assertNotEqual(instance.pk, expired.pk)
+
+
+@skipIf(Verification is None, "settings.VERIFICATION_MODEL is not configured")
+@skipIf(connection.vendor == 'sqlite', "sqlite serializes writers, there is no race to exercise")
+@skipUnlessDBFeature('supports_partial_indexes')
+class ConcurrentPasswordResetTests(TransactionTestCase):
+
+    def setUp(self):
+        User.objects.create_user(username='testuser', email='test@example.com', password='testpassword')
+
+    def test_parallel_requests_create_one_verification(self):
+        barrier = threading.Barrier(8)
+
+        def request_reset():
+            barrier.wait()
+            try:
+                return RequestPasswordResetSerializer().create({'email': 'test@example.com'}).pk
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pks = set(executor.map(lambda _: request_reset(), range(8)))
+        self.assertEqual(len(pks), 1)
+        self.assertEqual(Verification.objects.filter(email='test@example.com', expired=False).count(), 1)
+
+
+@skipIf(Verification is None, "settings.VERIFICATION_MODEL is not configured")
+@override_settings(SMS_BACKEND='authentication.sms.LocMemSMSBackend')
+class OutboxTests(APITestCase):
+
+    def setUp(self):
+        sms.outbox.clear()
+        self.verification = Verification.objects.create(phone='0555123456')
+
+    def test_send_only_queues(self):
+        self.verification.send()
+        self.assertEqual(sms.outbox, [])
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(len(sms.outbox), 1)
+        self.assertEqual(OutboxMessage.objects.due().count(), 0)
+
+    def test_failed_delivery_is_retried_later(self):
+        self.verification.send()
+        with mock.patch('authentication.sms.LocMemSMSBackend.send_messages', side_effect=OSError('gateway down')):
+            drain_outbox()
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(message.sent_at)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+
+    def test_expired_verification_is_given_up(self):
+        self.verification.send()
+        Verification.objects.filter(pk=self.verification.pk).update(expired=True)
+        self.assertEqual(drain_outbox(), 1)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(sms.outbox, [])
+        self.assertTrue(message.given_up)
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.otp, '')
+
+    def test_messages_without_gateway_result_are_failures(self):
+        self.verification.send()
+        with mock.patch('authentication.sms.LocMemSMSBackend.send_messages', return_value=[]):
+            drain_outbox()
+        message = OutboxMessage.objects.get()
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.last_error, 'no result from the SMS gateway')
+
+
+class PasswordResetRendererTests(APITestCase):
+
+    def test_template_is_loaded_once_per_language(self):
+        renderer = PasswordResetEmailRenderer()
+        verifications = [SimpleNamespace(email=f'user{i}@example.com', raw_otp='abc', reset_link='https://x/?otp=abc')
+                         for i in range(3)]
+        with mock.patch('authentication.mail.select_template') as select_template:
+            messages = renderer.build_messages(verifications, language='fr')
+            renderer.build_messages(verifications, language='fr')
+        select_template.assert_called_once_with(['mail/fr/password_reset.html', 'mail/password_reset.html'])
+        self.assertEqual([message.to for message in messages], [[v.email] for v in verifications])
+
+
+@skipIf(Verification is None, "settings.VERIFICATION_MODEL is not configured")
+@override_settings(OTP_STORE={'TTL': 600, 'MAX_ATTEMPTS': 2})
+class OTPStoreTests(APITestCase):
+
+    def setUp(self):
+        self.verification = Verification.objects.create(email='test@example.com')
+        self.otp = self.verification.raw_otp
+
+    def test_otp_is_stored_hashed(self):
+        self.assertNotEqual(self.verification.otp, self.otp)
+        self.assertTrue(Verification.objects.filter(otp=hash_otp(self.otp)).exists())
+
+    def test_otp_expires_after_ttl(self):
+        Verification.objects.filter(pk=self.verification.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        with self.assertRaises(OTPExpired):
+            get_otp_store().get(self.otp)
+
+    def test_uses_are_limited(self):
+        store = get_otp_store()
+        store.get(self.otp)
+        self.assertTrue(store.is_valid(self.otp))
+        store.get(self.otp)
+        self.assertFalse(store.is_valid(self.otp))
+        with self.assertRaises(OTPExpired):
+            store.get(self.otp)
+
+    def test_is_valid_counts_no_use(self):
+        store = get_otp_store()
+        for _ in range(3):
+            self.assertTrue(store.is_valid(self.otp))
+        self.assertFalse(store.is_valid('wrong'))
+
+    def test_bulk_created_verifications_get_distinct_unknown_otps(self):
+        Verification.objects.bulk_create([Verification(phone='0555000001'), Verification(phone='0555000002')])
+        self.assertEqual(Verification.objects.values('otp').distinct().count(), 3)
+
+    @override_settings(OTP_STORE={'BACKEND': 'cache', 'TTL': 600, 'MAX_ATTEMPTS': 2})
+    def test_cache_backend_validates_without_database(self):
+        verification = Verification.objects.create(phone='0555123456')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_otp_store().get(verification.raw_otp).pk, verification.pk)
+
+    def test_purge_deletes_stale_verifications(self):
+        Verification.objects.filter(pk=self.verification.pk).update(expired=True)
+        call_command('purge_verifications', batch_size=1, stdout=StringIO())
+        self.assertFalse(Verification.objects.exists())
+
+
+class OTPGeneratorTests(APITestCase):
+
+    def test_batch_is_distinct_and_uses_alphabet(self):
+        otps = generate_otps(1000, length=9, alphabet='ABC123')
+        self.assertEqual(len(set(otps)), 1000)
+        self.assertTrue(all(len(otp) == 9 and set(otp) <= set('ABC123') for otp in otps))
+
+    def test_non_ascii_alphabet(self):
+        otps = generate_otps(50, length=6, alphabet='αβγδ')
+        self.assertTrue(all(len(otp) == 6 and set(otp) <= set('αβγδ') for otp in otps))
+
+    def test_count_beyond_the_otp_space_is_rejected(self):
+        with self.assertRaises(ValueError):
+            generate_otps(9, length=1, alphabet='AB')
+
+    @skipIf(Verification is None, "settings.VERIFICATION_MODEL is not configured")
+    def test_unique_otps_skip_stored_ones(self):
+        taken = Verification.objects.create(email='test@example.com')
+        generated = iter([[taken.raw_otp, 'fresh01'], ['fresh02']])
+        with mock.patch('authentication.otp.generate_otps', side_effect=lambda *args: next(generated)), \
+                self.assertNumQueries(2):
+            pairs = generate_unique_otps(2)
+        self.assertEqual(sorted(otp for otp, digest in pairs), ['fresh01', 'fresh02'])
+
+    def test_entropy_report(self):
+        report = otp_entropy_report(count=1000)
+        self.assertAlmostEqual(report['entropy_bits'], 7 * math.log2(61))
+        self.assertLess(report['collision_probability'], 1e-4)
+        self.assertAlmostEqual(report['guess_success_probability'], 30 * report['new_otp_collision_probability'],
+                               delta=1e-12)
+
+
+class CountingPermission(BasePermission):
+    cost = 5
+    calls = 0
+    cache_key = 'counting'
+
+    def has_permission(self, request, view):
+        CountingPermission.calls += 1
+        return False
+
+    def has_objects_permission(self, request, view, objs):
+        CountingPermission.calls += 1
+        return [obj % 2 == 0 for obj in objs]
+
+
+class CompositePermissionTests(APITestCase):
+
+    def setUp(self):
+        CountingPermission.calls = 0
+        self.request = Request(RequestFactory().get('/'))
+        self.request.user = AnonymousUser()
+
+    def test_shared_children_are_evaluated_once(self):
+        permission = Or([CountingPermission, And([IsReadOnly, CountingPermission]), IsStaff])
+        self.assertFalse(permission.has_permission(self.request, None))
+        self.assertEqual(CountingPermission.calls, 1)
+
+    def test_instances_without_cache_key_are_evaluated_apart(self):
+        class IsUser(BasePermission):
+            def __init__(self, username=''):
+                self.username = username
+
+            def has_permission(self, request, view):
+                return request.user.get_username() == self.username
+
+        permission = And([IsUser(''), IsUser('admin')])
+        self.assertFalse(permission.has_permission(self.request, None))
+
+    def test_cheap_checks_run_first(self):
+        permission = And([CountingPermission, IsStaff])
+        self.assertEqual([type(perm) for perm in permission.perms], [IsStaff, CountingPermission])
+        self.assertFalse(permission.has_permission(self.request, None))
+        self.assertEqual(CountingPermission.calls, 0)
+
+    def test_object_permissions_are_checked_in_batch(self):
+        permission = And([IsReadOnly, CountingPermission])
+        self.assertEqual(permission.has_objects_permission(self.request, None, [1, 2, 3, 4]),
+                         [False, True, False, True])
+        self.assertEqual(CountingPermission.calls, 1)
+
+
+class CachedPermissionsTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.group = Group.objects.create(name='teachers')
+        self.user.groups.add(self.group)
+        self.group.permissions.add(Permission.objects.get(codename='add_group'))
+        self.user.user_permissions.add(Permission.objects.get(codename='view_group'))
+        self.backend = PhoneBackend()
+
+    def fresh_user(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def unsaved_copy(self):
+        user = User(pk=self.user.pk, username=self.user.username, is_active=True)
+        user._state.adding = False
+        return user
+
+    def test_permissions_are_loaded_once_across_requests(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.backend.has_perm(self.unsaved_copy(), 'auth.add_group'))
+        with self.assertNumQueries(0):
+            user = self.unsaved_copy()
+            self.assertTrue(self.backend.has_perm(user, 'auth.view_group'))
+            self.assertFalse(self.backend.has_perm(user, 'auth.delete_group'))
+            self.assertEqual(self.backend.get_group_permissions(user), {'auth.add_group'})
+            self.assertEqual(self.backend.get_user_permissions(user), {'auth.view_group'})
+
+    def test_membership_change_invalidates_user(self):
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'auth.add_group'))
+        self.user.groups.remove(self.group)
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'auth.add_group'))
+
+    def test_group_permission_change_invalidates_members(self):
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'auth.delete_group'))
+        self.group.permissions.add(Permission.objects.get(codename='delete_group'))
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'auth.delete_group'))
+
+    def test_user_permission_change_invalidates_user(self):
+        self.user.user_permissions.clear()
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'auth.view_group'))
+
+    def test_evicted_generation_never_revives_stale_sets(self):
+        cache.delete(PERMISSIONS_GENERATION_KEY)
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'auth.delete_group'))
+        self.group.permissions.add(Permission.objects.get(codename='delete_group'))
+        cache.delete(PERMISSIONS_GENERATION_KEY)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'auth.delete_group'))
+
+
+class CatalogViewTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.client.force_authenticate(self.user)
+        Group.objects.bulk_create([Group(name=f'group-{i}') for i in range(3)])
+        self.groups_url = reverse('groups')
+
+    def test_pages_follow_the_primary_key(self):
+        response = self.client.get(self.groups_url, {'page_size': 2})
+        self.assertEqual([group['name'] for group in response.data['results']], ['group-0', 'group-1'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([group['name'] for group in response.data['results']], ['group-2'])
+
+    def test_matching_etag_gets_not_modified(self):
+        etag = self.client.get(self.groups_url)['ETag']
+        response = self.client.get(self.groups_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_group_change_invalidates_cached_pages(self):
+        etag = self.client.get(self.groups_url)['ETag']
+        Group.objects.create(name='group-3')
+        response = self.client.get(self.groups_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_evicted_generation_never_revives_stale_pages(self):
+        cache.delete(PERMISSIONS_GENERATION_KEY)
+        etag = self.client.get(self.groups_url)['ETag']
+        Group.objects.create(name='group-3')
+        cache.delete(PERMISSIONS_GENERATION_KEY)
+        response = self.client.get(self.groups_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_cached_page_builds_links_for_each_request(self):
+        self.client.get(self.groups_url, {'page_size': 2})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.groups_url, {'page_size': 2, 'utm_source': 'mail'})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIn('utm_source=mail', response.data['next'])
+
+    def test_detail(self):
+        group = Group.objects.get(name='group-1')
+        response = self.client.get(reverse('group', args=[group.pk]))
+        self.assertEqual(response.data, {'id': group.pk, 'name': 'group-1'})
+
+
+class CurrentContextTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+
+    def test_middleware_exposes_and_clears_the_request(self):
+        request = RequestFactory().get('/', HTTP_REFERER='https://app.theschool.pro/')
+        request.user = self.user
+
+        def view(request):
+            self.assertIs(CurrentApplicationContext.get_request(), request)
+            self.assertEqual(CurrentApplicationContext.context.referrer, 'https://app.theschool.pro/')
+            self.assertEqual(CurrentApplicationContext.context.user, self.user)
+            return HttpResponse()
+
+        CurrentContextMiddleware(view)(request)
+        self.assertFalse(hasattr(CurrentApplicationContext.context, 'request'))
+
+    def test_anonymous_user_is_not_exposed(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        with CurrentApplicationContext.using(request=request):
+            self.assertFalse(hasattr(CurrentApplicationContext.context, 'user'))
+            self.assertIsNone(CurrentApplicationContext.get_user())
+
+    def test_concurrent_tasks_keep_their_own_context(self):
+        async def task(user):
+            with CurrentTaskContext.using(user=user):
+                await asyncio.sleep(0)
+                return CurrentApplicationContext.get_user()
+
+        async def main():
+            return await asyncio.gather(task('first'), task('second'))
+
+        self.assertEqual(asyncio.run(main()), ['first', 'second'])
+        self.assertIsNone(CurrentApplicationContext.get_user())
+
+    def test_task_init_and_release(self):
+        CurrentTaskContext.init(current_host='theschool.pro')
+        self.assertIsNone(CurrentTaskContext.context.user)
+        self.assertEqual(CurrentTaskContext.context.current_host, 'theschool.pro')
+        CurrentTaskContext.release()
+        self.assertFalse(hasattr(CurrentTaskContext.context, 'current_host'))
+
+
+class TopNPerGroupTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([User(username=f'user{i}') for i in range(100)])
+        MultiToken.objects.issue([user for user in users for _ in range(100)])
+
+    def test_top_n_is_one_query(self):
+        with self.assertNumQueries(1):
+            tokens = list(top_n_per_group(MultiToken.objects.all(), 'user', 3, ['-created']))
+        self.assertEqual(len(tokens), 300)
+        self.assertTrue(all(token.group_rank <= 3 for token in tokens))
+
+    def test_prefetch_top_n_has_a_fixed_query_count(self):
+        with self.assertNumQueries(2):
+            users = list(User.objects.prefetch_related(prefetch_top_n(User, 'tokens', 3, to_attr='recent_tokens')))
+        self.assertEqual(len(users), 100)
+        self.assertEqual({len(user.recent_tokens) for user in users}, {3})
+
+
+class SchemaModelTestCase(TransactionTestCase):
+    """
+    Creates the tables of the test only `models` for the test case, in order, and drops them afterwards.
+    """
+    models = []
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.models):
+                editor.delete_model(model)
+        super().tearDownClass()
+
+
+class Category(DeletableModel):
+    name = models.CharField(max_length=50)
+
+    objects = CustomCategoryManager()
+
+    class Meta:
+        app_label = 'authentication'
+
+
+class SubCategory(DeletableModel):
+    category = models.ForeignKey(Category, related_name='sub_categories', on_delete=models.CASCADE)
+    name = models.CharField(max_length=50)
+
+    class Meta:
+        app_label = 'authentication'
+
+
+class Product(DeletableModel):
+    sub_category = models.ForeignKey(SubCategory, related_name='products', on_delete=models.CASCADE)
+    name = models.CharField(max_length=50)
+
+    class Meta:
+        app_label = 'authentication'
+
+
+class CategoryManagerTests(SchemaModelTestCase):
+    models = [Category, SubCategory, Product]
+
+    def setUp(self):
+        self.category = Category.objects.create(name='books')
+        hidden_category = Category.objects.create(name='archive', visible=False)
+        self.novels = self.sub_category(self.category, 'novels', visible=5, hidden=1)
+        self.comics = self.sub_category(self.category, 'comics', visible=3, hidden=2)
+        self.poetry = self.sub_category(self.category, 'poetry', visible=4, hidden=0, sub_visible=False)
+        self.sub_category(hidden_category, 'old', visible=4, hidden=0)
+
+    def sub_category(self, category, name, visible, hidden, sub_visible=True):
+        sub = SubCategory.objects.create(category=category, name=name, visible=sub_visible)
+        Product.objects.bulk_create([Product(sub_category=sub, name=f'{name} {i}', visible=i < visible)
+                                     for i in range(visible + hidden)])
+        return sub
+
+    def test_categories_with_3_products_count_visible_products(self):
+        with self.assertNumQueries(3):
+            categories = Category.objects.category_with_3_products()
+        # comics has 5 products but only 3 visible ones, poetry is hidden but still listed.
+        self.assertEqual(sorted(products[0].sub_category_id for _, products in categories),
+                         [self.novels.pk, self.poetry.pk])
+        for category, products in categories:
+            self.assertEqual(category, self.category)
+            self.assertEqual(len(products), 3)
+            self.assertTrue(all(product.visible for product in products))
+
+    def test_with_sub_cats_lists_visible_sub_categories(self):
+        with self.assertNumQueries(2):
+            categories = Category.objects.with_sub_cats()
+        self.assertEqual(len(categories), 1)
+        self.assertEqual(categories[0]['id'], self.category.pk)
+        self.assertEqual({sub['name'] for sub in categories[0]['subs']}, {'novels', 'comics'})
+
+
+class Note(DeletableModel):
+    title = models.CharField(max_length=50)
+
+    class Meta:
+        app_label = 'authentication'
+        indexes = [visible_index('title', name='authentication_note_title_vis')]
+
+
+class DeletableModelTests(SchemaModelTestCase):
+    models = [Note]
+
+    def setUp(self):
+        Note.objects.bulk_create([Note(title=f'note {i}') for i in range(10)])
+
+    def test_queryset_delete_is_one_soft_update(self):
+        with self.assertNumQueries(1) as queries:
+            deleted = Note.objects.filter(title__in=['note 1', 'note 2']).delete()
+        self.assertEqual(deleted, (2, {'authentication.Note': 2}))
+        self.assertTrue(queries.captured_queries[0]['sql'].startswith('UPDATE'))
+        self.assertEqual(Note.objects.count(), 8)
+        self.assertEqual(Note.all_objects.count(), 10)
+        self.assertEqual(Note.objects.invisible().count(), 2)
+
+    def test_restore(self):
+        Note.objects.all().soft_delete()
+        self.assertEqual(Note.all_objects.restore(), 10)
+        self.assertEqual(Note.objects.count(), 10)
+
+    def test_instance_delete_updates_two_columns(self):
+        note = Note.objects.first()
+        with self.assertNumQueries(1) as queries:
+            note.delete()
+        sql = queries.captured_queries[0]['sql']
+        self.assertIn('"visible"', sql)
+        self.assertNotIn('"title"', sql)
+        self.assertFalse(Note.objects.filter(pk=note.pk).exists())
+
+    def test_force_delete_in_batches(self):
+        Note.objects.filter(title__in=['note 1', 'note 2', 'note 3']).delete()
+        # two chunks, each a SELECT of the keys and a DELETE in its own transaction, and the final empty SELECT.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Note.all_objects.invisible().force_delete(batch_size=2), 3)
+        statements = [query['sql'].split(' ', 1)[0] for query in queries]
+        self.assertEqual(statements.count('SELECT'), 3)
+        self.assertEqual(statements.count('DELETE'), 2)
+        self.assertEqual(Note.all_objects.count(), 7)
+
+
+class TrackedNote(DiffHistoryModel):
+    title = models.CharField(max_length=50)
+    body = models.TextField(blank=True)
+
+    class Meta:
+        app_label = 'authentication'
+
+
+class DiffHistoryTests(SchemaModelTestCase):
+    models = [TrackedNote]
+
+    def setUp(self):
+        ContentType.objects.clear_cache()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+
+    def test_only_changed_fields_are_recorded(self):
+        with CurrentTaskContext.using(user=self.user, referrer='https://app.theschool.pro/'):
+            note = TrackedNote.objects.create(title='draft', body='text')
+            note = TrackedNote.objects.get(pk=note.pk)
+            note.title = 'final'
+            note.save()
+            note.save()
+        created, changed = ChangeLog.objects.for_object(note).order_by('pk')
+        self.assertEqual(created.action, ChangeLog.CREATE)
+        self.assertEqual(changed.changes, {'title': ['draft', 'final']})
+        self.assertEqual(changed.user_id, self.user.pk)
+        self.assertEqual(changed.referrer, 'https://app.theschool.pro/')
+
+    def test_entries_are_written_on_commit(self):
+        with transaction.atomic():
+            notes = [TrackedNote.objects.create(title=f'note {i}') for i in range(3)]
+            self.assertEqual(ChangeLog.objects.count(), 0)
+        self.assertEqual(ChangeLog.objects.count(), 3)
+        with self.assertRaises(ValueError), transaction.atomic():
+            notes[0].delete()
+            raise ValueError
+        self.assertEqual(ChangeLog.objects.count(), 3)
+
+    def test_entries_of_rolled_back_savepoints_are_dropped(self):
+        with transaction.atomic():
+            TrackedNote.objects.create(title='kept')
+            with self.assertRaises(ValueError), transaction.atomic():
+                TrackedNote.objects.create(title='dropped')
+                raise ValueError
+        self.assertEqual(ChangeLog.objects.count(), 1)
+        self.assertEqual(ChangeLog.objects.get().changes['title'], [None, 'kept'])
+
+    def test_bulk_update_with_history(self):
+        TrackedNote.objects.bulk_create([TrackedNote(title=f'note {i}') for i in range(10)])
+        notes = list(TrackedNote.objects.all())
+        for note in notes[:5]:
+            note.body = 'edited'
+        ContentType.objects.get_for_model(TrackedNote)
+        # one UPDATE of the five edited notes and one INSERT of their change log entries.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(bulk_update_with_history(notes, ['body']), 5)
+        statements = [query['sql'].split(' ', 1)[0] for query in queries]
+        self.assertEqual((statements.count('UPDATE'), statements.count('INSERT')), (1, 1))
+        self.assertEqual(ChangeLog.objects.filter(action=ChangeLog.UPDATE).count(), 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(bulk_update_with_history(notes, ['body']), 0)
+
+    def test_saves_of_a_transaction_are_written_with_one_insert(self):
+        ContentType.objects.get_for_model(TrackedNote)
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            notes = [TrackedNote.objects.create(title=f'note {i}') for i in range(10)]
+            for note in notes:
+                note.body = 'edited'
+                note.save()
+        inserts = [query for query in queries if query['sql'].startswith(f'INSERT INTO "{ChangeLog._meta.db_table}"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ChangeLog.objects.count(), 20)
+
+    def test_rolled_back_entries_do_not_leak_into_the_next_transaction(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            TrackedNote.objects.create(title='dropped')
+            raise ValueError
+        with transaction.atomic():
+            TrackedNote.objects.create(title='kept')
+        self.assertEqual(ChangeLog.objects.get().changes['title'], [None, 'kept'])
+
+    def test_compact_merges_old_entries(self):
+        note = TrackedNote.objects.create(title='a')
+        for title in ('b', 'c'):
+            note.title = title
+            note.save()
+        ChangeLog.objects.update(created_at=timezone.now() - timedelta(days=60))
+        call_command('compact_history', stdout=StringIO())
+        entry = ChangeLog.objects.for_object(note).get()
+        self.assertEqual(entry.action, ChangeLog.CREATE)
+        self.assertEqual(entry.changes['title'], [None, 'c'])
+
+
+class SyncedNote(DeletableModel, SyncableModel):
+    title = models.CharField(max_length=50)
+
+    class Meta(SyncableModel.Meta):
+        app_label = 'authentication'
+
+
+class SyncedNoteSerializer(ModelSerializer):
+    class Meta:
+        model = SyncedNote
+        fields = ('id', 'title')
+
+
+class SyncedNoteView(ChangedSinceMixin, ListAPIView):
+    queryset = SyncedNote.all_objects.all()
+    serializer_class = SyncedNoteSerializer
+    authentication_classes = []
+    permission_classes = []
+
+
+class ChangedSinceTests(SchemaModelTestCase):
+    models = [SyncedNote]
+
+    def setUp(self):
+        SyncedNote.objects.bulk_create([SyncedNote(title=f'note {i}') for i in range(5)])
+
+    def sync(self, cursor=None, page_size=2):
+        params = {'page_size': page_size}
+        if cursor:
+            params['cursor'] = cursor
+        return SyncedNoteView.as_view()(APIRequestFactory().get('/', params)).data
+
+    def test_pages_walk_the_whole_table_once(self):
+        cursor, titles, has_more = None, [], True
+        while has_more:
+            page = self.sync(cursor)
+            titles += [note['title'] for note in page['results']]
+            cursor, has_more = page['cursor'], page['has_more']
+        self.assertEqual(sorted(set(titles)), [f'note {i}' for i in range(5)])
+
+    def test_last_cursor_reads_the_lag_window_again(self):
+        page = self.sync(page_size=10)
+        self.assertEqual(len(self.sync(page['cursor'], page_size=10)['results']), 5)
+        with mock.patch.object(SyncedNoteView, 'sync_lag', 0):
+            page = self.sync(page_size=10)
+            self.assertEqual(self.sync(page['cursor'], page_size=10)['results'], [])
+
+    def test_delta_includes_tombstones(self):
+        cursor = self.sync(page_size=10)['cursor']
+        SyncedNote.objects.filter(title='note 1').delete()
+        note = SyncedNote.objects.get(title='note 2')
+        note.title = 'edited'
+        note.save()
+        page = self.sync(cursor, page_size=10)
+        self.assertIn('edited', [row['title'] for row in page['results']])
+        self.assertEqual(page['deleted'], [SyncedNote.all_objects.get(title='note 1').pk])
+
+    def test_view_scope_applies(self):
+        with mock.patch.object(SyncedNoteView, 'queryset', SyncedNote.all_objects.filter(title='note 3')):
+            page = self.sync(page_size=10)
+        self.assertEqual([row['title'] for row in page['results']], ['note 3'])
+
+    def test_invalid_cursor(self):
+        response = SyncedNoteView.as_view()(APIRequestFactory().get('/', {'cursor': 'nope'}))
+        self.assertEqual(response.status_code, 400)
+
+
+class MonthlyTokens(RollupModel):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    tokens = models.PositiveIntegerField(default=0)
+
+    rollup_source = MultiToken
+    rollup_date_field = 'created'
+    rollup_watermark_field = 'created'
+    rollup_dimensions = ('user',)
+
+    @classmethod
+    def rollup_aggregates(cls):
+        return {'tokens': Count('pk')}
+
+    class Meta:
+        app_label = 'authentication'
+        constraints = [models.UniqueConstraint(fields=['bucket', 'user'], name='authentication_monthlytokens_uniq')]
+
+
+class ReportingTests(SchemaModelTestCase):
+    models = [MonthlyTokens]
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        MultiToken.objects.issue([self.user] * 5)
+        self.now = timezone.now()
+        last_month = self.now.replace(day=1) - timedelta(days=1)
+        MultiToken.objects.filter(pk__in=MultiToken.objects.values('pk')[:2]).update(created=last_month)
+
+    def test_round_and_month(self):
+        row = MultiToken.objects.annotate(month=Month('created'), rounded=Round(Value(1.2345))) \
+            .filter(Q(month=self.now.month) | Q(month=0)).values('month', 'rounded').first()
+        self.assertEqual(row, {'month': self.now.month, 'rounded': 1.23})
+
+    def test_bucketed_counts_per_month(self):
+        rows = list(bucketed(MultiToken.objects.all(), 'created', 'month', tokens=Count('pk')))
+        self.assertEqual([row['tokens'] for row in rows], [2, 3])
+        self.assertEqual(rows[1]['bucket'], bucket_start(self.now, 'month'))
+        current = bucketed(MultiToken.objects.all(), 'created', 'month', start=self.now, tokens=Count('pk'))
+        self.assertEqual([row['tokens'] for row in current], [3])
+
+    def test_incremental_rollup_refresh(self):
+        self.assertEqual(MonthlyTokens.objects.refresh(), 2)
+        self.assertEqual(sorted(MonthlyTokens.objects.values_list('tokens', flat=True)), [2, 3])
+        MultiToken.objects.issue([self.user])
+        self.assertEqual(MonthlyTokens.objects.refresh_incremental(), 1)
+        current = MonthlyTokens.objects.get(bucket=bucket_start(self.now, 'month'))
+        self.assertEqual(current.tokens, 4)
+        self.assertEqual(MonthlyTokens.objects.refresh_incremental(), 0)
+
+    def test_empty_rollup_keeps_its_watermark(self):
+        MonthlyTokens.objects.refresh()
+        MonthlyTokens.objects.all().delete()
+        self.assertEqual(MonthlyTokens.objects.refresh_incremental(), 0)
+
+    def test_rollups_need_a_unique_constraint(self):
+        self.assertEqual(MonthlyTokens.check(), [])
+        with mock.patch.object(MonthlyTokens._meta, 'constraints', []):
+            self.assertEqual([error.id for error in MonthlyTokens.check()], ['authentication.E001'])
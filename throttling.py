@@ -0,0 +1,206 @@
+"""
+Sliding window rate limiting for the login and password reset endpoints.
+
+Every check is O(1): the window is approximated from the counters of the current and the previous
+fixed windows. Rates are configured in `settings.AUTH_RATE_LIMITS`:
+
+    AUTH_RATE_LIMITS = {
+        'BACKEND': 'cache',  # or 'local' for a single process
+        'RATES': {'login_ip': '30/min', 'login_identifier': '10/min', ...},
+    }
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+from authentication.validators import normalize_phone
+
+DEFAULT_RATE_LIMITS = {
+    'BACKEND': 'cache',
+    'CACHE_ALIAS': 'default',
+    'RATES': {
+        'login_ip': '60/min',
+        'login_identifier': '10/min',
+        'reset_request_ip': '20/hour',
+        'reset_request_identifier': '5/hour',
+        'otp_ip': '30/hour',
+        'otp_identifier': '10/hour',
+    },
+}
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    '10/min' -> (10, 60), None -> (None, None)
+    """
+    if rate is None:
+        return None, None
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+def get_rate_limit_settings() -> dict:
+    config = {**DEFAULT_RATE_LIMITS, **getattr(settings, 'AUTH_RATE_LIMITS', {})}
+    config['RATES'] = {**DEFAULT_RATE_LIMITS['RATES'], **config['RATES']}
+    return config
+
+
+class LocalRateLimitBackend:
+    """
+    In-process counters, only correct when a single process serves the endpoints.
+
+    Keys are kept in the order they were last hit, every hit drops the stale ones from the front.
+    """
+
+    def __init__(self):
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, window_index, period):
+        now = window_index * period
+        with self._lock:
+            index, current, previous, _ = self._windows.pop(key, (window_index, 0, 0, 0))
+            if index != window_index:
+                previous = current if index == window_index - 1 else 0
+                current = 0
+            current += 1
+            # the counters still weigh in the estimate until the end of the next window.
+            self._windows[key] = (window_index, current, previous, (window_index + 2) * period)
+            self._prune(now)
+            return current, previous
+
+    def _prune(self, now):
+        while self._windows:
+            key = next(iter(self._windows))
+            if self._windows[key][3] > now:
+                return
+            del self._windows[key]
+
+    def reset(self):
+        with self._lock:
+            self._windows.clear()
+
+
+class CacheRateLimitBackend:
+    """
+    Counters kept in django's cache framework, shared by every node using the same cache.
+    """
+
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    def hit(self, key, window_index, period):
+        cache = caches[self.cache_alias]
+        current_key, previous_key = f'{key}:{window_index}', f'{key}:{window_index - 1}'
+        cache.add(current_key, 0, timeout=2 * period)
+        current = cache.incr(current_key)
+        previous = cache.get(previous_key, 0)
+        return current, previous
+
+    def reset(self):
+        pass
+
+
+class RateLimiter:
+
+    def __init__(self, backend, clock=time.time):
+        self.backend = backend
+        self.clock = clock
+        self.allowed = Counter()
+        self.rejected = Counter()
+
+    def hit(self, rate_name: str, ident: str, limit: int, period: int) -> bool:
+        """
+        Counts an attempt for `ident` and returns whether it stays within `limit` attempts per `period`.
+        """
+        now = self.clock()
+        window_index, elapsed = divmod(now, period)
+        key = f'ratelimit:{rate_name}:{hashlib.sha256(ident.encode()).hexdigest()}'
+        current, previous = self.backend.hit(key, int(window_index), period)
+        estimate = previous * (1 - elapsed / period) + current
+        if estimate > limit:
+            self.rejected[rate_name] += 1
+            return False
+        self.allowed[rate_name] += 1
+        return True
+
+    def stats(self) -> dict:
+        return {'allowed': dict(self.allowed), 'rejected': dict(self.rejected)}
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        config = get_rate_limit_settings()
+        if config['BACKEND'] == 'local':
+            backend = LocalRateLimitBackend()
+        else:
+            backend = CacheRateLimitBackend(config['CACHE_ALIAS'])
+        _rate_limiter = RateLimiter(backend)
+    return _rate_limiter
+
+
+def reset_rate_limiter():
+    global _rate_limiter
+    _rate_limiter = None
+
+
+def normalize_identifier(value: str) -> str:
+    value = str(value).strip()
+    return normalize_phone(value) or value.lower()
+
+
+class AuthRateThrottle(BaseThrottle):
+    """
+    Limits attempts per client IP and per submitted identifier, checked before any hashing or query.
+    """
+
+    scope = None
+    identifier_fields = ()
+
+    def get_identifiers(self, request):
+        data = getattr(request, 'data', None) or request.POST
+        query_params = getattr(request, 'query_params', request.GET)
+        for field in self.identifier_fields:
+            value = data.get(field) or query_params.get(field)
+            if value:
+                yield normalize_identifier(value)
+
+    def allow_request(self, request, view):
+        rates = get_rate_limit_settings()['RATES']
+        limiter = get_rate_limiter()
+        checks = [('ip', self.get_ident(request))] + [('identifier', ident) for ident in self.get_identifiers(request)]
+        for kind, ident in checks:
+            rate_name = f'{self.scope}_{kind}'
+            limit, period = parse_rate(rates.get(rate_name))
+            if limit is not None and not limiter.hit(rate_name, ident, limit, period):
+                self.period = period
+                return False
+        return True
+
+    def wait(self):
+        return getattr(self, 'period', None)
+
+
+class LoginRateThrottle(AuthRateThrottle):
+    scope = 'login'
+    identifier_fields = ('username', 'access_code')
+
+
+class PasswordResetRequestThrottle(AuthRateThrottle):
+    scope = 'reset_request'
+    identifier_fields = ('email', 'phone')
+
+
+class OTPRateThrottle(AuthRateThrottle):
+    scope = 'otp'
+    identifier_fields = ('otp',)
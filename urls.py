@@ -11,4 +11,11 @@ urlpatterns = [
     path("check-login/", CheckAuth.as_view(), name="check_login"),
     path("session-login/", SessionLogin.as_view(), name="session_login"),
     path("logout/", LogoutAPIView.as_view(), name="logout"),
+    path("tokens/revoke/", RevokeTokensAPIView.as_view(), name="revoke_tokens"),
+    path("tokens/bulk-issue/", BulkIssueTokensAPIView.as_view(), name="bulk_issue_tokens"),
+    path("tokens/bulk-revoke/", BulkRevokeTokensAPIView.as_view(), name="bulk_revoke_tokens"),
+    path("permissions/", PermissionView.as_view(), name="permissions"),
+    path("permissions/<int:pk>/", PermissionView.as_view(), name="permission"),
+    path("groups/", GroupView.as_view(), name="groups"),
+    path("groups/<int:pk>/", GroupView.as_view(), name="group"),
 ]
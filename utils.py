@@ -1,14 +1,99 @@
-import random
+import secrets
 import string
 
+from django.utils.crypto import salted_hmac
 
-def generate_otp():
-    chars = string.ascii_lowercase + string.ascii_uppercase + '123456789'
-    otp = ""
-    for i in range(7):
-        otp += random.choice(chars)
-    return otp
+OTP_ALPHABET = string.ascii_lowercase + string.ascii_uppercase + '123456789'
+OTP_LENGTH = 7
+
+
+def _otp_characters(count: int, alphabet: str):
+    """
+    `count` characters drawn uniformly from `alphabet` (1 to 256 symbols) with the `secrets` module.
+
+    Random bytes are mapped with bytes.translate, bytes above the largest multiple of the alphabet size
+    are dropped so every symbol stays equally likely. Non ASCII alphabets are mapped to symbol indexes first.
+    """
+    size = len(alphabet)
+    if not 0 < size <= 256:
+        raise ValueError(f"The OTP alphabet must hold 1 to 256 symbols, not {size}.")
+    symbols = alphabet.encode() if alphabet.isascii() else bytes(range(size))
+    limit = 256 - 256 % size
+    table = bytes(symbols[i % size] if i < limit else 0 for i in range(256))
+    rejected = bytes(range(limit, 256))
+    chars = b''
+    while len(chars) < count:
+        # ask for a bit more than needed to absorb the rejected bytes in one go.
+        chars += secrets.token_bytes((count - len(chars)) * 256 // limit + 16).translate(table, rejected)
+    if alphabet.isascii():
+        return chars[:count].decode()
+    return ''.join(alphabet[index] for index in chars[:count])
+
+
+def generate_otps(count: int, length: int = OTP_LENGTH, alphabet: str = OTP_ALPHABET) -> list:
+    """
+    `count` cryptographically random OTPs, duplicates within the batch are replaced.
+
+    Raises ValueError when `count` exceeds the number of distinct OTPs.
+    """
+    if count > len(alphabet) ** length:
+        raise ValueError(f"Can't generate {count} distinct OTPs of {length} symbols out of {len(alphabet)}.")
+    otps = set()
+    while len(otps) < count:
+        missing = count - len(otps)
+        chars = _otp_characters(missing * length, alphabet)
+        otps.update(chars[i:i + length] for i in range(0, len(chars), length))
+    return list(otps)
+
+
+def generate_otp(length: int = OTP_LENGTH, alphabet: str = OTP_ALPHABET) -> str:
+    return _otp_characters(length, alphabet)
 
 
 def get_verification_model():
-    pass
+    """
+    Returns the concrete Verification model named by `settings.VERIFICATION_MODEL` ("app_label.ModelName"),
+    None when the project doesn't define one.
+    """
+    from django.apps import apps
+    from django.conf import settings
+
+    model = getattr(settings, 'VERIFICATION_MODEL', None)
+    if model is None:
+        return None
+    return apps.get_model(model, require_ready=False)
+
+
+def access_code_digest(access_code: str) -> str:
+    """
+    Keyed (SECRET_KEY) digest under which access codes are stored and looked up.
+    """
+    return salted_hmac('authentication.access_code', access_code, algorithm='sha256').hexdigest()
+
+
+def access_code_digests(access_code: str) -> list:
+    """
+    Digests of the access code under SECRET_KEY then each of SECRET_KEY_FALLBACKS, digests stored before a
+    key rotation are still found.
+    """
+    from django.conf import settings
+
+    return [access_code_digest(access_code)] + [
+        salted_hmac('authentication.access_code', access_code, secret=secret, algorithm='sha256').hexdigest()
+        for secret in getattr(settings, 'SECRET_KEY_FALLBACKS', [])
+    ]
+
+
+def unknown_otp_digest() -> str:
+    """
+    Default of `Verification.otp` for rows created without `save` (`bulk_create`): unique and matching
+    no OTP, the verification gets a real one from `rotate_otp` when it is sent.
+    """
+    return secrets.token_hex(32)
+
+
+def hash_otp(otp: str) -> str:
+    """
+    Keyed (SECRET_KEY) digest under which OTPs are stored and looked up.
+    """
+    return salted_hmac('authentication.otp', otp, algorithm='sha256').hexdigest()
@@ -3,6 +3,32 @@ from django.utils.regex_helper import _lazy_re_compile
 from django.utils.translation import gettext as _
 
 
+PHONE_PREFIXES = ('+213', '00213', '0')
+
+
+def normalize_phone(value: str):
+    """
+    Returns the phone number in its canonical `+213XXXXXXXXX` form, None when it isn't a valid phone number.
+    """
+    value = ''.join(value.split())
+    if not PhoneValidator.phone_regex.match(value):
+        return None
+    for prefix in PHONE_PREFIXES:
+        if value.startswith(prefix):
+            return PHONE_PREFIXES[0] + value[len(prefix):]
+
+
+def phone_variants(value: str) -> list:
+    """
+    Every spelling accepted by PhoneValidator of the given phone number, empty when it isn't a phone number.
+    """
+    canonical = normalize_phone(value)
+    if canonical is None:
+        return []
+    national = canonical[len(PHONE_PREFIXES[0]):]
+    return [prefix + national for prefix in PHONE_PREFIXES]
+
+
 class PhoneValidator:
     message = _('Enter a valid phone number.')
     code = "invalid"
@@ -1,23 +1,38 @@
 from importlib import import_module
+from urllib.parse import parse_qs, urlencode, urlsplit
 
 from django.conf import settings
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, login, get_user_model
 from django.contrib.auth.models import update_last_login, Permission, Group
+from django.core.cache import cache
 from django.forms import model_to_dict
 from django.shortcuts import render, redirect
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.utils.translation import gettext as _
 from django.views import View
 from rest_framework.authtoken.views import ObtainAuthToken
-from rest_framework.generics import GenericAPIView, RetrieveAPIView, ListAPIView, CreateAPIView
+from rest_framework.generics import GenericAPIView, CreateAPIView
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 
+from authentication.caches import CATALOG_CACHE_KEY, get_user_group_names, get_permissions_generation, \
+    get_permissions_changed_at
+from authentication.executors import HashingPoolFull
 from authentication.forms import LoginForm
-from authentication.models import MultiToken, Verification
+from authentication.managers import USERS_PER_QUERY
+from authentication.models import MultiToken
+from authentication.otp import get_otp_store
+from authentication.pagination import KeysetPagination
 from authentication.permissions import IsReadOnly
 from authentication.serializers import AdvancedAuthTokenSerializer, PasswordResetSerializer, \
-    RequestPasswordResetSerializer, PermissionSerializer, GroupSerializer
+    RequestPasswordResetSerializer, RevokeTokensSerializer, \
+    BulkIssueTokensSerializer, BulkRevokeTokensSerializer, PermissionSerializer, GroupSerializer
+from authentication.throttling import LoginRateThrottle, OTPRateThrottle, PasswordResetRequestThrottle
+from authentication.writers import last_login_writer
 
 
 class SessionLogin(View):
@@ -25,9 +40,15 @@ class SessionLogin(View):
         return render(request, "login.html")
 
     def post(self, request, *args, **kwargs):
+        if not LoginRateThrottle().allow_request(request, self):
+            return render(request, "login.html", status=429)
         form = LoginForm(request.POST)
         if form.is_valid():
-            user = authenticate(request, username=form.cleaned_data['username'], password=form.cleaned_data['password'])
+            try:
+                user = authenticate(request, username=form.cleaned_data['username'],
+                                    password=form.cleaned_data['password'])
+            except HashingPoolFull:
+                return render(request, "login.html", status=429)
             if user:
                 login(request, user)
                 return redirect("/")
@@ -36,6 +57,7 @@ class SessionLogin(View):
 
 class LoginAPIView(ObtainAuthToken):
     serializer_class = AdvancedAuthTokenSerializer
+    throttle_classes = [LoginRateThrottle]
 
     def post(self, request, *args, **kwargs):
         context = dict(request=request, view=self)
@@ -43,7 +65,7 @@ class LoginAPIView(ObtainAuthToken):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         self.run_custom_validation(user)
-        update_last_login(None, user, )
+        self.update_last_login(user)
         token = MultiToken.objects.create(user=user)
         data = {'token': token.key}
         data.update(
@@ -52,10 +74,18 @@ class LoginAPIView(ObtainAuthToken):
                 fields=('email', 'phone', 'id', 'selected_language',)
             )
         )
-        data['groups'] = [group.name for group in user.groups.all()]
+        data['groups'] = get_user_group_names(user)
 
         return Response(data)
 
+    def update_last_login(self, user):
+        if last_login_writer.enabled:
+            user.last_login = timezone.now()
+            last_login_writer.touch(user.pk)
+            last_login_writer.maybe_flush()
+        else:
+            update_last_login(None, user, )
+
     def run_custom_validation(self, user):
         if hasattr(settings, 'MORE_USER_VALIDATION') and settings.MORE_USER_VALIDATION != 'NONE':
             module_name, func_name = settings.MORE_USER_VALIDATION.rsplit('.', 1)
@@ -69,7 +99,7 @@ class CheckAuth(APIView):
     http_method_names = ['get']
 
     def get(self, request, *args, **kwargs):
-        data = {"groups": [group.name for group in request.user.groups.all()]}
+        data = {"groups": get_user_group_names(request.user)}
         return Response({"connected": True, **data})
 
 
@@ -82,13 +112,68 @@ class LogoutAPIView(APIView):
         return Response(status=204)
 
 
+class RevokeTokensAPIView(GenericAPIView):
+    """
+    Revokes the authenticated user's tokens, all of them or those of one device.
+    """
+    permission_classes = [IsAuthenticated]
+    http_method_names = ['post']
+    serializer_class = RevokeTokensSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        tokens = MultiToken.objects.filter(user=request.user)
+        if serializer.validated_data.get('device_name'):
+            tokens = tokens.for_device(serializer.validated_data['device_name'])
+        if serializer.validated_data['keep_current'] and request.auth is not None:
+            tokens = tokens.exclude(key=request.auth.key)
+        return Response({"revoked": tokens.revoke()})
+
+
+class BulkIssueTokensAPIView(GenericAPIView):
+    permission_classes = [IsAdminUser]
+    http_method_names = ['post']
+    serializer_class = BulkIssueTokensSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        users = get_user_model().objects.filter(pk__in=serializer.validated_data['users']).values_list('pk', flat=True)
+        tokens = MultiToken.objects.issue(users, device_name=serializer.validated_data['device_name'])
+        return Response([{"user": token.user_id, "token": token.key} for token in tokens], status=201)
+
+
+class BulkRevokeTokensAPIView(GenericAPIView):
+    permission_classes = [IsAdminUser]
+    http_method_names = ['post']
+    serializer_class = BulkRevokeTokensSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        tokens = MultiToken.objects.all()
+        if 'device_name' in data:
+            tokens = tokens.for_device(data['device_name'])
+        if 'older_than' in data:
+            tokens = tokens.older_than(data['older_than'])
+        if 'users' not in data:
+            return Response({"revoked": tokens.revoke()})
+        users = data['users']
+        revoked = sum(tokens.for_users(users[start:start + USERS_PER_QUERY]).revoke()
+                      for start in range(0, len(users), USERS_PER_QUERY))
+        return Response({"revoked": revoked})
+
+
 class ResetPasswordApiView(GenericAPIView):
     http_method_names = ['post', 'get']
     serializer_class = PasswordResetSerializer
+    throttle_classes = [OTPRateThrottle]
 
     def get(self, request, *args, **kwargs):
         if request.query_params.get('otp'):
-            if Verification.objects.filter(otp=request.query_params.get('otp'), expired=False).exists():
+            if get_otp_store().is_valid(request.query_params.get('otp')):
                 return Response({"valid": True})
         return Response({"valid": False})
 
@@ -102,6 +187,7 @@ class ResetPasswordApiView(GenericAPIView):
 
 class RequestPasswordResetApiView(CreateAPIView):
     serializer_class = RequestPasswordResetSerializer
+    throttle_classes = [PasswordResetRequestThrottle]
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -111,13 +197,81 @@ class RequestPasswordResetApiView(CreateAPIView):
         return Response(response)
 
 
-class PermissionView(ListAPIView, RetrieveAPIView):
+class CatalogView(GenericAPIView):
+    """
+    Read-only list and detail of a small, rarely changing table, `.values()` rows of the serializer's fields.
+
+    Pages are cached server side and tagged with an ETag until a group or a permission changes,
+    clients sending it back get a 304.
+    """
+    pagination_class = KeysetPagination
+    catalog_name = None
+
+    def get_queryset(self):
+        return super().get_queryset().values(*self.get_serializer_class().Meta.fields)
+
+    def get_etag(self, request, *args, **kwargs):
+        return f'"{self.catalog_name}-{get_permissions_generation()}"'
+
+    def get_last_modified(self, request, *args, **kwargs):
+        return get_permissions_changed_at()
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request, *args, **kwargs)
+        last_modified = self.get_last_modified(request, *args, **kwargs)
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=last_modified and int(last_modified.timestamp()))
+        if response is None:
+            if self.lookup_field in kwargs:
+                response = Response(self.get_serializer(self.get_object()).data)
+            else:
+                response = Response(self.get_page_data(request))
+        response.headers['ETag'] = etag
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    def get_page_data(self, request):
+        """
+        The page's rows are cached under its cursor and page size only, the links are built for each request.
+        """
+        paginator = self.paginator
+        params = {paginator.page_size_query_param: paginator.get_page_size(request)}
+        if request.query_params.get(paginator.cursor_query_param):
+            params[paginator.cursor_query_param] = request.query_params[paginator.cursor_query_param]
+        key = CATALOG_CACHE_KEY.format(self.catalog_name, get_permissions_generation(),
+                                       urlencode(sorted(params.items())))
+        page = cache.get(key)
+        if page is None:
+            rows = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+            page = {
+                'next': self.get_link_cursor(paginator.get_next_link()),
+                'previous': self.get_link_cursor(paginator.get_previous_link()),
+                'results': list(self.get_serializer(rows, many=True).data),
+            }
+            cache.set(key, page, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 3600))
+        url = request.build_absolute_uri()
+        return {
+            'next': page['next'] and replace_query_param(url, paginator.cursor_query_param, page['next']),
+            'previous': page['previous'] and replace_query_param(url, paginator.cursor_query_param, page['previous']),
+            'results': page['results'],
+        }
+
+    def get_link_cursor(self, link):
+        if link is None:
+            return None
+        return parse_qs(urlsplit(link).query)[self.paginator.cursor_query_param][0]
+
+
+class PermissionView(CatalogView):
     queryset = Permission.objects.all()
     permission_classes = [IsAdminUser]
     serializer_class = PermissionSerializer
+    catalog_name = 'permissions'
 
 
-class GroupView(ListAPIView, RetrieveAPIView):
+class GroupView(CatalogView):
     queryset = Group.objects.all()
     permission_classes = [IsAuthenticated, IsReadOnly]
     serializer_class = GroupSerializer
+    catalog_name = 'groups'
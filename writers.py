@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class BatchedTimestampWriter:
+    """
+    Buffers "seen at" timestamps in memory and writes them back with a single UPDATE per flush.
+
+    The stored timestamp is the flush time, it runs ahead of the real event by at most the flush interval.
+    """
+
+    field = None
+    # pks per UPDATE, below SQLite's 999 query parameters.
+    chunk_size = 500
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._pending = {}
+        self._pending_since = None
+        self._lock = threading.Lock()
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def get_flush_limits(self):
+        """
+        Returns (flush interval in seconds, maximum number of pending rows).
+        """
+        return 60, 5000
+
+    def touch(self, pk):
+        with self._lock:
+            if not self._pending:
+                self._pending_since = self.clock()
+            self._pending[pk] = timezone.now()
+
+    def last_seen(self, pk):
+        return self._pending.get(pk)
+
+    def flush_due(self) -> bool:
+        interval, max_pending = self.get_flush_limits()
+        return bool(self._pending) and (
+            len(self._pending) >= max_pending or self.clock() - self._pending_since >= interval
+        )
+
+    def flush(self) -> int:
+        with self._lock:
+            pks, self._pending = list(self._pending), {}
+        now = timezone.now()
+        return sum(
+            self.get_queryset().filter(pk__in=pks[start:start + self.chunk_size]).update(**{self.field: now})
+            for start in range(0, len(pks), self.chunk_size)
+        )
+
+    def reset(self):
+        """
+        Drops the pending timestamps without writing them.
+        """
+        with self._lock:
+            self._pending = {}
+
+    def maybe_flush(self) -> int:
+        return self.flush() if self.flush_due() else 0
+
+
+class LastLoginWriter(BatchedTimestampWriter):
+    """
+    Deferred replacement of `update_last_login`, enabled by `settings.DEFERRED_LAST_LOGIN['ENABLED']`.
+    """
+
+    field = 'last_login'
+    defaults = {'ENABLED': False, 'FLUSH_INTERVAL': 30, 'MAX_PENDING': 1000}
+
+    def get_settings(self) -> dict:
+        return {**self.defaults, **getattr(settings, 'DEFERRED_LAST_LOGIN', {})}
+
+    @property
+    def enabled(self) -> bool:
+        return self.get_settings()['ENABLED']
+
+    def get_queryset(self):
+        from django.contrib.auth import get_user_model
+
+        return get_user_model()._default_manager.all()
+
+    def get_flush_limits(self):
+        config = self.get_settings()
+        return config['FLUSH_INTERVAL'], config['MAX_PENDING']
+
+
+last_login_writer = LastLoginWriter()